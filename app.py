@@ -1,11 +1,20 @@
-from flask import Flask, request, jsonify, make_response, abort
-from db import Wall
+from flask import Flask, request, jsonify, make_response, abort, g
+import logging
+import os
+import time
+from db import db, init_db, Wall, create_walls, update_walls, delete_walls
 import json
-from decimal import Decimal
-from trade_agent import get_market_trade_history
-from walls import Walls
+from decimal import Decimal, InvalidOperation
+from wall_registry import WallRegistry, build_wall
+from wall_listing import WallListing
+from metrics import REGISTRY, CONTENT_TYPE
+from logs import setup_logging
 
 app = Flask(__name__)
+logger = logging.getLogger("app")
+wall_registry = WallRegistry()
+wall_listing = WallListing(wall_registry)
+request_seconds = REGISTRY.histogram("api_request_seconds", "API request latency", ["method", "endpoint", "status"])
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -16,13 +25,34 @@ class DecimalEncoder(json.JSONEncoder):
 def cors_middleware(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE, PUT'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,X-Api-Key,baggage,sentry-trace'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,X-Api-Key,baggage,sentry-trace,If-None-Match'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag,X-Next-Cursor'
     return response
 
+@app.before_request
+def open_connection():
+    g.started = time.perf_counter()
+    # Creates or upgrades the schema on the first request rather than on import; later calls return right away
+    init_db()
+    # peewee connections are per thread; each request thread opens its own and closes it when done
+    db.connect(reuse_if_open=True)
+
+@app.teardown_request
+def close_connection(exc):
+    if not db.is_closed():
+        db.close()
+
 @app.after_request
 def after_request_func(response):
+    # The route pattern rather than the path, so /api/walls/<int:wall_id> is one series
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_seconds.observe(time.perf_counter() - g.started, method=request.method, endpoint=endpoint, status=response.status_code)
     return cors_middleware(response)
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return make_response(REGISTRY.render(), 200, {'Content-Type': CONTENT_TYPE})
+
 @app.route('/api/greet', methods=['GET', 'OPTIONS'])
 def greet():
     if request.method == 'OPTIONS':
@@ -30,31 +60,53 @@ def greet():
     response = {"status": "Connected"}
     return jsonify(response)
 
+def same_amount(text, amount):
+    try:
+        return amount is not None and Decimal(str(text)) == amount
+    except InvalidOperation:
+        return False
+
 @app.route('/api/walls/<int:wall_id>', methods=['PUT'])
 def updateWall(wall_id):
+    """
+    Updates one wall. Fields the request leaves out keep their stored values, so a client that doesn't know about
+    ladders keeps a wall's quantities and spread. A quantity sent without quantities that differs from the first
+    level replaces the ladder with a single level of that quantity, as does quantities set to null. The merged
+    wall is validated like the bulk endpoints' walls; an invalid one gets a 400 with the errors and is not saved.
+    """
     data = request.json
-    wall = Wall.get_by_id(wall_id)
-    if wall:
-        wall.pair = data['pair']
-        wall.quantity = data['quantity']
-        wall.ask_price = data['ask_price']
-        wall.bid_price = data['bid_price']
-        wall.keep = data['keep']
-        wall.save()
-        response = {"message": "Wall updated!"}
-    else:
-        response = {"message": "Wall not found!"}
-    return jsonify(response)
+    wall = Wall.get_or_none(Wall.id == wall_id)
+    if wall is None:
+        return jsonify({"message": "Wall not found!"})
+    if not isinstance(data, dict):
+        return make_response(jsonify({"message": "Expected a JSON object"}), 400)
+    merged = {field: getattr(wall, field) for field in WALL_FIELDS}
+    if wall.quantities:
+        merged['quantities'] = wall.quantities
+    merged.update((field, data[field]) for field in WALL_FIELDS if field in data)
+    if data.get('quantities') is not None:
+        merged['quantities'] = data['quantities']
+        if 'quantity' not in data:
+            # Defaults to the new first level
+            del merged['quantity']
+    elif 'quantities' in data or ('quantity' in data and not same_amount(data['quantity'], (wall.quantities or [None])[0])):
+        merged.pop('quantities', None)
+    merged['id'] = wall_id
+    row, errors = validate_wall(merged, require_id=True)
+    if errors:
+        return make_response(jsonify({"message": "Wall not updated", "errors": errors}), 400)
+    update_walls([row])
+    wall_listing.invalidate(wall_id)
+    return jsonify({"message": "Wall updated!"})
 
 @app.route('/api/walls/<int:wall_id>', methods=['DELETE'])
 def deleteWall(wall_id):
     if request.method == 'OPTIONS':
         return cors_middleware(make_response('', 204))
     wall = Wall.get_by_id(wall_id)
-    for h in wall.executions:
-        h.delete_instance()
     if wall:
-        wall.delete_instance()
+        delete_walls([wall_id])
+        wall_listing.invalidate(wall_id)
         response = {"message": "Wall deleted!"}
     else:
         response = {"message": "Wall not found!"}
@@ -62,39 +114,192 @@ def deleteWall(wall_id):
 
 @app.route('/api/walls', methods=['POST'])
 def addWall():
-    print("Received")
-    print("request", request)
-    print("request", request.json)
-    data = request.json
-    print("Add wall", data)
-    Wall.create(**data)
+    row, errors = validate_wall(request.json)
+    if errors:
+        return make_response(jsonify({"message": "Wall not added", "errors": errors}), 400)
+    wall = Wall.create(**row)
+    logger.info("wall added", extra={'wall': wall.id, 'pair': wall.pair})
+    wall_listing.invalidate(wall.id)
     response = {"message": "Wall added!"}
     return jsonify(response)
 
+WALL_FIELDS = ('pair', 'quantity', 'ask_price', 'bid_price', 'keep', 'spread')
+# Deepest ladder a wall may have
+MAX_LEVELS = 1000
+
+def validate_wall(data, require_id=False):
+    """
+    Checks a wall submitted to the API against the rules the Walls constructor and the agent rely on.
+    A ladder is given as quantities, a list with one quantity per level; quantity then defaults to the first.
+
+    Returns:
+    - A tuple (row, errors): row holds the Wall fields as strings, errors is a list of messages, empty if valid.
+    """
+    if not isinstance(data, dict):
+        return None, ["Expected an object"]
+    allowed = WALL_FIELDS + ('quantities',) + (('id',) if require_id else ())
+    required = ('pair', 'ask_price', 'bid_price') + (() if 'quantities' in data else ('quantity',)) + (('id',) if require_id else ())
+    errors = ["Missing " + field for field in required if field not in data]
+    errors += ["Unknown field " + field for field in data if field not in allowed]
+    if 'quantities' in data and (not isinstance(data['quantities'], list) or not 0 < len(data['quantities']) <= MAX_LEVELS):
+        errors.append("quantities must be a list of 1 to %d numbers" % MAX_LEVELS)
+    if errors:
+        return None, errors
+
+    row = {field: str(data[field]) for field in WALL_FIELDS if field in data}
+    row.setdefault('keep', "0")
+    row.setdefault('spread', "2")
+    row['quantities'] = [str(quantity) for quantity in data['quantities']] if 'quantities' in data else None
+    if row['quantities']:
+        row.setdefault('quantity', row['quantities'][0])
+    if require_id:
+        if not isinstance(data['id'], int):
+            return None, ["id must be an integer"]
+        row['id'] = data['id']
+    if len(row['pair'].split("/")) != 2 or "" in row['pair'].split("/"):
+        errors.append("pair must look like lhs/rhs")
+    values = {}
+    checks = [(field, getattr(Wall, field), row[field]) for field in ('quantity', 'ask_price', 'bid_price', 'keep', 'spread')]
+    checks += [("quantities[%d]" % i, Wall.quantity, quantity) for i, quantity in enumerate(row['quantities'] or [])]
+    for name, field, text in checks:
+        try:
+            values[name] = Decimal(text)
+        except InvalidOperation:
+            errors.append(name + " must be a number")
+            continue
+        if not values[name].is_finite() or values[name] < 0:
+            errors.append(name + " must be a finite number >= 0")
+            continue
+        try:
+            field.db_value(values[name])
+        except (ArithmeticError, ValueError) as e:
+            errors.append(name + " is out of range")
+            continue
+        # Stored at a fixed number of places, so anything finer would be silently rounded away
+        if values[name] and not field.round(values[name]):
+            errors.append("%s is below the smallest stored value, %s" % (name, format(field.unit, "f")))
+        elif field.round(values[name]) != values[name]:
+            errors.append("%s has more than %d decimal places" % (name, field.decimal_places))
+    if not errors:
+        quantities = [values[name] for name in values if name.startswith("quantit")]
+        if any(quantity <= 0 for quantity in quantities):
+            errors.append("quantity must be > 0")
+        if row['quantities'] and values['quantity'] != values['quantities[0]']:
+            errors.append("quantity must equal the first of quantities")
+        if values['spread'] < 1:
+            errors.append("spread must be >= 1")
+    if not errors:
+        try:
+            build_wall(Wall(**row))
+        except (AssertionError, ArithmeticError) as e:
+            errors.append(str(e))
+    return row, errors
+
+def bulk_items():
+    data = request.json
+    if isinstance(data, dict):
+        data = data.get('walls', data.get('ids'))
+    if not isinstance(data, list):
+        abort(make_response(jsonify({"message": "Expected a JSON list"}), 400))
+    return data
+
+def bulk_response(results):
+    ok = all(result['ok'] for result in results)
+    return make_response(jsonify({"message": "Walls saved!" if ok else "No walls saved, fix the errors and resubmit", "results": results}), 200 if ok else 400)
+
+@app.route('/api/walls/bulk', methods=['POST'])
+def addWalls():
+    """
+    Creates a list of walls. The whole batch is validated first and written in one transaction, or not at all.
+    """
+    items = bulk_items()
+    rows = []
+    results = []
+    for index, data in enumerate(items):
+        row, errors = validate_wall(data)
+        rows.append(row)
+        results.append({'index': index, 'ok': not errors, 'errors': errors})
+    if all(result['ok'] for result in results):
+        for result, wall_id in zip(results, create_walls(rows)):
+            result['id'] = wall_id
+        wall_listing.invalidate()
+    return bulk_response(results)
+
+@app.route('/api/walls/bulk', methods=['PUT'])
+def updateWalls():
+    """
+    Updates a list of walls, each with its id and all fields. The whole batch is validated first and written in one
+    transaction, or not at all.
+    """
+    items = bulk_items()
+    rows = []
+    results = []
+    for index, data in enumerate(items):
+        row, errors = validate_wall(data, require_id=True)
+        rows.append(row)
+        results.append({'index': index, 'ok': not errors, 'errors': errors})
+    ids = [row['id'] for row in rows if row is not None]
+    existing = {wall.id for wall in Wall.select(Wall.id).where(Wall.id.in_(ids))} if ids else set()
+    for row, result in zip(rows, results):
+        if row is not None and row['id'] not in existing:
+            result['ok'] = False
+            result['errors'].append("Wall not found")
+    if all(result['ok'] for result in results):
+        update_walls(rows)
+        for row, result in zip(rows, results):
+            result['id'] = row['id']
+        wall_listing.invalidate(*(row['id'] for row in rows))
+    return bulk_response(results)
+
+@app.route('/api/walls/bulk', methods=['DELETE'])
+def deleteWalls():
+    """
+    Deletes a list of wall ids with their executions, in one transaction, or none of them if any id is unknown.
+    """
+    items = bulk_items()
+    ids = [wall_id for wall_id in items if isinstance(wall_id, int)]
+    existing = {wall.id for wall in Wall.select(Wall.id).where(Wall.id.in_(ids))} if ids else set()
+    results = []
+    for index, wall_id in enumerate(items):
+        errors = [] if wall_id in existing else ["Wall not found"]
+        results.append({'index': index, 'ok': not errors, 'errors': errors, 'id': wall_id})
+    if all(result['ok'] for result in results):
+        delete_walls(ids)
+        wall_listing.invalidate(*ids)
+    return bulk_response(results)
+
 @app.route('/api/walls', methods=['GET', 'OPTIONS'])
 def listWalls():
+    """
+    Lists walls with their status as a JSON array, ordered by id.
+
+    Query parameters:
+    - pair (str, optional): Only walls trading this pair.
+    - limit (int, optional): Page size. When more walls follow, the X-Next-Cursor header holds the cursor for the next page.
+    - cursor (int, optional): Return walls after this cursor.
+
+    Responses carry an ETag; a request with a matching If-None-Match gets 304 Not Modified.
+    """
     if request.method == 'OPTIONS':
         return cors_middleware(make_response('', 204))
-    walls_query = Wall.select()
-    status = "TODO"
-
-    walls = []
-    for db_wall in walls_query:
-        wall = Walls(pair=db_wall.pair, bid_price=Decimal(db_wall.bid_price), ask_price=Decimal(db_wall.ask_price), keep=Decimal(db_wall.keep), quantities=[Decimal(db_wall.quantity)])
-        wall.print()
-        history = get_market_trade_history(db_wall)
-        print("WALL", wall.keep, wall.potential_spend(history))
-        walls += [{
-            'pair': db_wall.pair,
-            'quantity': db_wall.quantity,
-            'ask_price': db_wall.ask_price,
-            'bid_price': db_wall.bid_price,
-            'keep': db_wall.keep,
-            'id': db_wall.id,
-            'status': wall.status(history)
-        }]
-    return jsonify(walls)
+    pair = request.args.get('pair')
+    cursor = request.args.get('cursor', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return make_response(jsonify({"message": "limit must be at least 1"}), 400)
+
+    etag, body, next_cursor = wall_listing.page(pair, cursor, limit)
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(body)
+        response.mimetype = 'application/json'
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+    response.set_etag(etag)
+    return response
 
 
 if __name__ == '__main__':
+    setup_logging(os.getenv('LOG_LEVEL', 'INFO'))
     app.run(debug=True)
@@ -0,0 +1,75 @@
+"""
+Throughput of the sharded agent with 1, 2 and 4 shard processes over a large synthetic set of walls.
+
+A temporary database gets --walls walls spread over --pairs pairs. A synthetic price source random-walks every
+coin and ends after --polls polls; every poll updates every pair, so each run steps the same walls through the same
+prices and records the same fills. Each run starts from a database without executions, and its time includes the
+shards loading their walls.
+
+Throughput can only scale with the shard count on a machine with at least that many free cores.
+
+Usage: python benchmarks/sharded_agent.py [--walls 50000] [--pairs 500] [--polls 50] [--shards 1 2 4]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class RandomWalkSource:
+    def __init__(self, coins, polls, seed=1):
+        self.random = random.Random(seed)
+        self.prices = {coin: 1.0 for coin in coins}
+        self.polls = polls
+        self.done = False
+
+    def quotes(self, coins):
+        self.polls -= 1
+        self.done = self.polls <= 0
+        for coin in self.prices:
+            self.prices[coin] *= 1 + self.random.uniform(-0.02, 0.02)
+        quotes = {coin: (price, time.time()) for coin, price in self.prices.items()}
+        quotes['usd'] = (1.0, time.time())
+        return quotes
+
+    def close(self):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--walls', type=int, default=50000)
+    parser.add_argument('--pairs', type=int, default=500)
+    parser.add_argument('--polls', type=int, default=50)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    # Set before db is imported, here and in the spawned shard processes
+    os.environ['TRADING_DB'] = os.path.join(tempfile.mkdtemp(), "trading.sqlite")
+    from db import Outbox, OrderExecution, WallSummary, create_walls, init_db
+    from logs import setup_logging
+    from sharded_agent import ShardedAgent
+
+    setup_logging('WARNING')
+    init_db()
+    coins = ["c%d" % i for i in range(args.pairs)]
+    random.seed(2)
+    rows = []
+    for i in range(args.walls):
+        bid = Decimal(random.randint(80, 99)) / 100
+        rows.append({'pair': coins[i % args.pairs] + "/usd", 'bid_price': bid, 'ask_price': bid + Decimal("0.05"),
+                     'keep': Decimal(0), 'quantity': Decimal(10)})
+    create_walls(rows)
+    print("%d walls on %d pairs, %d polls, %d CPUs" % (args.walls, args.pairs, args.polls, os.cpu_count()))
+
+    for shards in args.shards:
+        for model in (Outbox, OrderExecution, WallSummary):
+            model.delete().execute()
+        agent = ShardedAgent(shards, RandomWalkSource(coins, args.polls), default_interval=0, refresh=3600, log_level='WARNING')
+        start = time.perf_counter()
+        agent.run()
+        seconds = time.perf_counter() - start
+        print("%d shard(s)  %6.1f s  %8.0f pair updates/s  %d fills" % (shards, seconds, agent.updates_sent / seconds, agent.fills))
@@ -0,0 +1,102 @@
+"""
+Concurrent read/write throughput of trading.sqlite, before and after the storage tuning in db.py.
+
+Writer processes record executions the way the agent does; reader processes load every wall with its summary the
+way GET /api/walls does. Each configuration runs against a fresh database in a temporary directory.
+
+Usage: python benchmarks/sqlite_concurrency.py [--writers 2] [--readers 4] [--seconds 5] [--walls 1000]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TRADING_DB', os.path.join(tempfile.mkdtemp(), 'bench.sqlite'))
+
+from peewee import SqliteDatabase, OperationalError, prefetch
+import db
+
+MODELS = [db.Wall, db.OrderExecution, db.WallSummary]
+
+CONFIGS = {
+    # What db.py did before: rollback journal, default pragmas, deferred transactions
+    'baseline': dict(pragmas={}, timeout=5, lock='DEFERRED'),
+    'tuned': dict(pragmas=db.PRAGMAS, timeout=10, lock='IMMEDIATE'),
+}
+
+def open_database(path, config):
+    database = SqliteDatabase(path, pragmas=config['pragmas'], timeout=config['timeout'])
+    database.bind(MODELS)
+    database.connect()
+    return database
+
+def writer(path, config, wall_ids, seconds, results):
+    database = open_database(path, config)
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    i = 0
+    while time.monotonic() < deadline:
+        wall_id = wall_ids[i % len(wall_ids)]
+        i += 1
+        try:
+            with database.atomic(config['lock']):
+                db.OrderExecution.create(wall=wall_id, amount="1", total_price="0.5", type='buy')
+                summary, _ = db.WallSummary.get_or_create(wall=wall_id)
+                summary.apply('buy', "1", "0.5")
+                summary.save()
+            done += 1
+        except OperationalError:
+            errors += 1
+    results.put(('write', done, errors))
+
+def reader(path, config, seconds, results):
+    database = open_database(path, config)
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            walls = prefetch(db.Wall.select(), db.WallSummary.select())
+            sum(len(wall.summaries) for wall in walls)
+            done += 1
+        except OperationalError:
+            errors += 1
+    results.put(('read', done, errors))
+
+def run(name, config, args, directory):
+    path = os.path.join(directory, name + '.sqlite')
+    database = open_database(path, config)
+    database.create_tables(MODELS)
+    with database.atomic():
+        wall_ids = [db.Wall.create(pair="near/nano", bid_price="0.4", ask_price="0.6", quantity="10").id for _ in range(args.walls)]
+    database.close()
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=writer, args=(path, config, wall_ids[i::args.writers], args.seconds, results)) for i in range(args.writers)]
+    processes += [multiprocessing.Process(target=reader, args=(path, config, args.seconds, results)) for _ in range(args.readers)]
+    for process in processes:
+        process.start()
+    totals = {'write': [0, 0], 'read': [0, 0]}
+    for _ in processes:
+        kind, done, errors = results.get()
+        totals[kind][0] += done
+        totals[kind][1] += errors
+    for process in processes:
+        process.join()
+
+    print("%-9s writes/s %8.1f  locked errors %5d  |  reads/s %8.1f  locked errors %5d" % (
+        name, totals['write'][0] / args.seconds, totals['write'][1], totals['read'][0] / args.seconds, totals['read'][1]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--walls', type=int, default=1000)
+    args = parser.parse_args()
+    db.db.close()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, config in CONFIGS.items():
+            run(name, config, args, directory)
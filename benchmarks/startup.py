@@ -0,0 +1,76 @@
+"""
+Import time of the entry-point modules, measured with python -X importtime in fresh interpreters.
+
+For each module it prints the best total of --repeat runs and the heaviest top-level imports. Importing must not
+touch the database or load modules that are only needed later (the CoinGecko feed's aiohttp, requests for
+webhooks): the run fails if one of them is loaded, if the database file is created, or if a module takes
+longer than --max-ms.
+
+Usage: python benchmarks/startup.py [--repeat 5] [--top 8] [--max-ms 0] [app trade_agent ...]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules each entry point should only load when the code that needs them first runs
+DEFERRED = {
+    'app': ['aiohttp', 'requests', 'price_feed', 'trade_agent'],
+    'trade_agent': ['aiohttp', 'requests', 'price_feed', 'flask'],
+    'db': ['aiohttp', 'requests', 'flask'],
+}
+
+def import_times(module, database):
+    """
+    Imports module in a new interpreter. Returns {name: (cumulative_us, depth)} for module and every module it
+    loaded, depth 0 being module itself; what the interpreter imported at startup is left out.
+    """
+    env = dict(os.environ, TRADING_DB=database, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], env=env, cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    lines = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        lines.append((name.strip(), int(cumulative), (len(name) - len(name.lstrip())) // 2))
+    # Each module's line follows the lines of the modules it imported
+    end = max(i for i, (name, _, depth) in enumerate(lines) if name == module and depth == 0)
+    start = end
+    while start > 0 and lines[start - 1][2] > 0:
+        start -= 1
+    return {name: (cumulative, depth) for name, cumulative, depth in lines[start:end + 1]}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('modules', nargs='*', default=['app', 'trade_agent', 'db'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--max-ms', type=float, default=0, help="fail when a module takes longer; 0 disables")
+    args = parser.parse_args()
+
+    failed = False
+    database = os.path.join(tempfile.mkdtemp(), "startup.sqlite")
+    for module in args.modules:
+        runs = [import_times(module, database) for _ in range(args.repeat)]
+        best = min(runs, key=lambda times: times[module][0])
+        total_ms = best[module][0] / 1000
+        print("%-12s %7.1f ms  (%d modules)" % (module, total_ms, len(best)))
+        top_level = sorted(((cumulative, name) for name, (cumulative, depth) in best.items() if depth == 1), reverse=True)
+        for cumulative, name in top_level[:args.top]:
+            print("    %-28s %7.1f ms" % (name, cumulative / 1000))
+
+        loaded = [name for name in DEFERRED.get(module, []) if name in best]
+        if loaded:
+            print("    FAIL: importing %s loads %s" % (module, ", ".join(loaded)))
+            failed = True
+        if args.max_ms and total_ms > args.max_ms:
+            print("    FAIL: %.1f ms is over --max-ms %.1f" % (total_ms, args.max_ms))
+            failed = True
+    if os.path.exists(database):
+        print("FAIL: importing created the database")
+        failed = True
+    sys.exit(1 if failed else 0)
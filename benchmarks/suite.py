@@ -0,0 +1,189 @@
+"""
+Benchmark suite for the strategy, storage, API and agent cycle on synthetic walls and fills, with results saved as
+JSON so runs can be compared.
+
+Cases, for every number of walls and, where the database is involved, every number of fills:
+- step, potential_spend: Walls (Decimal) and FixedWalls, what the backtests and the agent run, over all walls.
+- history: load_walls(executions=True) and get_market_trade_history() for every wall.
+- cycle: one full trade_agent.process_walls() against a stub price source that quotes every pair between its walls'
+  bid and ask, so nothing fills and every cycle does the same work.
+- api_cold, api_warm: GET /api/walls through the Flask test client with empty caches and with warm ones.
+
+Each database is generated once in a temporary directory. Walls spread over 20 pairs; fills alternate buy and sell
+round-robin over the walls. Every case is timed with timeit's autorange and repeated; the median is printed and
+the fastest run is what --compare checks.
+
+Usage: python benchmarks/suite.py [--walls 10 1000 100000] [--fills 0 1000 1000000] [--quick] [--only step cycle]
+                                  [--output results.json] [--compare previous.json] [--threshold 1.25]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from walls import Walls, FixedWalls
+
+PAIRS = ["c%d/usd" % i for i in range(20)]
+CASES = ('step', 'potential_spend', 'history', 'cycle', 'api_cold', 'api_warm')
+
+def generate_walls(count, seed=1):
+    """
+    Returns count wall rows as dicts of Wall fields, bids between 0.30 and 0.45 and asks between 0.55 and 0.70.
+    """
+    rng = random.Random(seed)
+    return [{'pair': PAIRS[i % len(PAIRS)], 'bid_price': Decimal(rng.randint(30, 45)) / 100, 'ask_price': Decimal(rng.randint(55, 70)) / 100,
+             'keep': Decimal(0), 'quantity': Decimal(10)} for i in range(count)]
+
+def generate_fills(wall_ids, count):
+    """
+    Yields count executions as (wall, type, amount, total_price) rows, alternating buy and sell per wall.
+    """
+    for i in range(count):
+        wall_id = wall_ids[i % len(wall_ids)]
+        if (i // len(wall_ids)) % 2 == 0:
+            yield (wall_id, 'buy', Decimal(10), Decimal(4))
+        else:
+            yield (wall_id, 'sell', Decimal(10), Decimal(6))
+
+def use_database(path):
+    db.db.close()
+    db.db.init(path, pragmas=db.PRAGMAS, timeout=10)
+    db.db.connect()
+
+def create_database(path, walls, fills):
+    use_database(path)
+    db.db.create_tables([db.Wall, db.OrderExecution, db.WallSummary, db.Outbox])
+    wall_ids = db.create_walls(generate_walls(walls))
+    fields = [db.OrderExecution.wall, db.OrderExecution.type, db.OrderExecution.amount, db.OrderExecution.total_price]
+    with db.db.atomic('IMMEDIATE'):
+        for batch in db.chunked(generate_fills(wall_ids, fills), 5000):
+            db.OrderExecution.insert_many(batch, fields=fields).execute()
+    db.rebuild_summaries()
+
+class StubSource:
+    """Quotes every coin at 0.5 USD, between the bid and ask of every generated wall."""
+    def quotes(self, coins):
+        return {coin: (1.0 if coin == 'usd' else 0.5, 0) for coin in coins}
+
+def measure(function, repeat):
+    timer = timeit.Timer(function)
+    loops, _ = timer.autorange()
+    times = [seconds / loops for seconds in timer.repeat(repeat, loops)]
+    return {'median': statistics.median(times), 'min': min(times), 'loops': loops, 'repeat': repeat}
+
+def memory_cases(walls, repeat):
+    rows = generate_walls(walls)
+    price = Decimal("0.5")
+    for cls in (Walls, FixedWalls):
+        built = [cls(pair=row['pair'], bid_price=row['bid_price'], ask_price=row['ask_price'], keep=row['keep'], quantities=[row['quantity']]) for row in rows]
+        yield 'step', cls.__name__, measure(lambda: [wall.step(price) for wall in built], repeat)
+        yield 'potential_spend', cls.__name__, measure(lambda: [wall.potential_spend() for wall in built], repeat)
+
+def database_cases(selected, repeat):
+    # Imported here: they read the database, which is generated first
+    import app
+    import trade_agent
+    from wall_history import load_walls, get_market_trade_history
+    from wall_listing import WallListing
+    from wall_registry import WallRegistry
+
+    if 'history' in selected:
+        yield 'history', None, measure(lambda: [get_market_trade_history(wall) for wall in load_walls(executions=True)], repeat)
+    if 'cycle' in selected:
+        yield 'cycle', None, measure(lambda: trade_agent.process_walls(StubSource()), repeat)
+    client = app.app.test_client()
+
+    def cold():
+        app.wall_listing = WallListing(WallRegistry())
+        assert client.get('/api/walls').status_code == 200
+
+    if 'api_cold' in selected:
+        yield 'api_cold', None, measure(cold, repeat)
+    if 'api_warm' in selected:
+        cold()
+        yield 'api_warm', None, measure(lambda: client.get('/api/walls').status_code, repeat)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def key(result):
+    return "%s[%s]" % (result['case'], ",".join("%s=%s" % (name, result[name]) for name in ('impl', 'walls', 'fills') if result.get(name) is not None))
+
+def compare(results, path, threshold):
+    """
+    Prints each case's fastest run against the same case in a previous results file, the least noisy figure for
+    comparing runs. Returns the keys of the cases that got slower by more than threshold times.
+    """
+    with open(path) as f:
+        previous = {key(result): result for result in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        ratio = result['min'] / old['min']
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key(result))
+            flag = "  REGRESSION"
+        print("%-52s %10.3f ms -> %10.3f ms  %5.2fx%s" % (key(result), old['min'] * 1000, result['min'] * 1000, ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--walls', type=int, nargs='+', default=[10, 1000, 100000])
+    parser.add_argument('--fills', type=int, nargs='+', default=[0, 1000, 1000000])
+    parser.add_argument('--quick', action='store_true', help="only 10 and 1000 walls with 0 and 1000 fills")
+    parser.add_argument('--only', nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark-results.json"),
+                        help="results file, by default benchmarks/benchmark-results.json")
+    parser.add_argument('--compare', help="results file of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+    if args.quick:
+        args.walls, args.fills = [10, 1000], [0, 1000]
+
+    results = []
+
+    def report(case, impl, walls, fills, timing):
+        result = dict(case=case, impl=impl, walls=walls, fills=fills, **timing)
+        results.append(result)
+        print("%-52s %10.3f ms  (%d loops)" % (key(result), timing['median'] * 1000, timing['loops']), flush=True)
+
+    for walls in args.walls:
+        for case, impl, timing in memory_cases(walls, args.repeat):
+            if case in args.only:
+                report(case, impl, walls, None, timing)
+
+    selected = set(args.only) - {'step', 'potential_spend'}
+    with tempfile.TemporaryDirectory() as directory:
+        for walls in args.walls if selected else []:
+            for fills in args.fills:
+                create_database(os.path.join(directory, "w%d_f%d.sqlite" % (walls, fills)), walls, fills)
+                for case, impl, timing in database_cases(selected, args.repeat):
+                    report(case, impl, walls, fills, timing)
+        db.db.close()
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'python': platform.python_version(), 'machine': platform.platform(), 'cpus': os.cpu_count(),
+                   'results': results}, f, indent=1)
+    print("Saved", len(results), "results to", args.output)
+    if args.compare:
+        sys.exit(1 if compare(results, args.compare, args.threshold) else 0)
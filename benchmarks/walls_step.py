@@ -0,0 +1,47 @@
+"""
+step() throughput of Walls with Decimal parameters against FixedWalls, which runs the same strategy on integers.
+
+Both walls are built the way wall_registry.build_wall builds them from the database and step through the same
+sin-wave prices, once as Decimals (what the agent passes) and once as floats (what backtests pass), recording
+every fill.
+
+Usage: python benchmarks/walls_step.py [--steps 100000] [--levels 3] [--spread 2]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from walls import Walls, FixedWalls
+
+def run(cls, prices, levels, spread):
+    wall = cls(pair="near/nano", bid_price=Decimal("0.4"), ask_price=Decimal("0.6"), keep=Decimal(10), spread=spread,
+               quantities=[Decimal(10 * 2 ** level) for level in range(levels)])
+    fills = 0
+    start = time.perf_counter()
+    for unit_price in prices:
+        proposed_action = wall.step(unit_price)
+        if proposed_action is not None:
+            wall.record(proposed_action)
+            fills += 1
+    return time.perf_counter() - start, fills
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--steps', type=int, default=100000)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--spread', type=Decimal, default=Decimal(2), help="price ratio between levels; deep ladders need one close to 1")
+    args = parser.parse_args()
+
+    floats = [(math.sin(0.017 * i) + 1) / 2.0 * 3.0 for i in range(args.steps)]
+    decimals = [Decimal(str(round(price, 8))) for price in floats]
+    for kind, prices in (('decimal', decimals), ('float', floats)):
+        baseline, baseline_fills = run(Walls, prices, args.levels, args.spread)
+        fixed, fixed_fills = run(FixedWalls, prices, args.levels, args.spread)
+        assert fixed_fills == baseline_fills
+        print("%-7s prices  Walls %8.0f steps/s  |  FixedWalls %8.0f steps/s  (%.1fx, %d fills)" % (
+            kind, args.steps / baseline, args.steps / fixed, baseline / fixed, fixed_fills))
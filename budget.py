@@ -0,0 +1,141 @@
+from decimal import Decimal, ROUND_DOWN
+
+# Fill amounts are stored with 8 decimal places
+AMOUNT_UNIT = Decimal(1).scaleb(-8)
+
+def spends(pair, action):
+    """
+    Returns (coin, amount) of what an action spends: the quote coin for a buy, the traded coin for a sell.
+    """
+    lhs, rhs = pair.split("/")
+    kind, (amount, price) = action
+    if kind == 'buy':
+        return rhs, amount * price
+    return lhs, amount
+
+class BudgetAllocator:
+    def __init__(self, balances=None, mode='scale'):
+        """
+        Keeps the walls' combined trades within the balances held of each coin.
+
+        allocate() takes every action proposed on one tick of price updates and totals what they spend per coin in one pass.
+        Where the total is over the balance left, the actions spending that coin are scaled down pro rata ('scale')
+        or funded in order until the balance runs out, the rest deferred ('defer'). A wall whose buy was cut short
+        still wants the remainder, so it is proposed again at the pair's next price. settle() moves a fill's amounts
+        between the balances. Coins without a balance are not limited.
+
+        Alongside, track() keeps each wall's potential_spend, the cost of the buys it still has open, summed per quote
+        coin, so committed() shows how far open buys exceed the balances without a pass over every wall.
+
+        Parameters:
+        - balances (dict, optional): {coin: Decimal} available to the walls.
+        - mode (str): 'scale' or 'defer'.
+
+        Example Usage:
+        allocator = BudgetAllocator({'nano': Decimal(1000)})
+        actions = allocator.allocate([(wall.pair, wall.step(price)) for wall in walls])
+        """
+        assert mode in ('scale', 'defer'), "mode must be 'scale' or 'defer'"
+        self.balances = {coin: Decimal(balance) for coin, balance in (balances or {}).items()}
+        self.mode = mode
+        self.open_buys = {}
+        self.commitments = {}
+
+    def allocate(self, proposals):
+        """
+        Parameters:
+        - proposals (list): (pair, action) for each action proposed on this tick; action may be None.
+
+        Returns:
+        - The actions to execute, in the order of proposals: unchanged, with a smaller amount, or None if deferred.
+        """
+        requested = {}
+        for pair, action in proposals:
+            if action is not None:
+                coin, amount = spends(pair, action)
+                if coin in self.balances:
+                    requested[coin] = requested.get(coin, 0) + amount
+        short = {coin: max(self.balances[coin], 0) for coin, amount in requested.items() if amount > self.balances[coin]}
+        if not short:
+            return [action for _, action in proposals]
+
+        remaining = dict(short)
+        result = []
+        for pair, action in proposals:
+            coin, amount = spends(pair, action) if action is not None else (None, 0)
+            if coin not in short:
+                result.append(action)
+            elif self.mode == 'defer':
+                if amount <= remaining[coin]:
+                    remaining[coin] -= amount
+                    result.append(action)
+                else:
+                    result.append(None)
+            else:
+                kind, (quantity, price) = action
+                quantity = (quantity * short[coin] / requested[coin]).quantize(AMOUNT_UNIT, rounding=ROUND_DOWN)
+                result.append((kind, (quantity, price)) if quantity > 0 else None)
+        return result
+
+    def settle(self, pair, action):
+        """
+        Moves an executed action's amounts between the balances: a buy spends the quote coin and adds the traded
+        coin, a sell the other way around.
+        """
+        lhs, rhs = pair.split("/")
+        kind, (amount, price) = action
+        changes = {rhs: -amount * price, lhs: amount} if kind == 'buy' else {lhs: -amount, rhs: amount * price}
+        for coin, change in changes.items():
+            if coin in self.balances:
+                self.balances[coin] += change
+
+    def track(self, wall_id, wall):
+        """
+        Records wall's current potential spend, replacing what was recorded for it before.
+        """
+        self.forget(wall_id)
+        coin = wall.pair.split("/")[1]
+        amount = wall.potential_spend()[1]
+        self.commitments[wall_id] = (coin, amount)
+        self.open_buys[coin] = self.open_buys.get(coin, 0) + amount
+
+    def forget(self, wall_id):
+        previous = self.commitments.pop(wall_id, None)
+        if previous is not None:
+            self.open_buys[previous[0]] -= previous[1]
+
+    def committed(self):
+        """
+        Returns {coin: (open buys, balance)} for the coins whose walls' open buys cost more than their balance.
+        """
+        return {coin: (amount, self.balances[coin]) for coin, amount in self.open_buys.items() if coin in self.balances and amount > self.balances[coin]}
+
+if __name__ == '__main__':
+    buy = lambda amount, price: ('buy', (Decimal(amount), Decimal(price)))
+    sell = lambda amount, price: ('sell', (Decimal(amount), Decimal(price)))
+    proposals = [("near/nano", buy(10, "0.5")), ("near/nano", buy(30, "0.5")), ("aurora/nano", None), ("near/usdc", buy(5, 2)), ("near/nano", sell(4, 1))]
+
+    # 20 nano asked for, 10 held: both buys are halved; usdc has no balance and near has enough for the sell
+    allocator = BudgetAllocator({'nano': 10, 'near': 5})
+    assert(allocator.allocate(proposals) == [buy(5, "0.5"), buy(15, "0.5"), None, buy(5, 2), sell(4, 1)])
+    allocator.settle("near/nano", buy(5, "0.5"))
+    assert(allocator.balances == {'nano': Decimal("7.5"), 'near': Decimal(10)})
+
+    # Funded in order: the second buy doesn't fit in what the first left
+    allocator = BudgetAllocator({'nano': 10}, mode='defer')
+    assert(allocator.allocate(proposals) == [buy(10, "0.5"), None, None, buy(5, 2), sell(4, 1)])
+
+    # Within budget nothing changes
+    assert(BudgetAllocator({'nano': 100}).allocate(proposals) == [action for _, action in proposals])
+
+    from walls import FixedWalls
+    wall = FixedWalls(pair="near/nano", bid_price=Decimal("0.4"), ask_price=Decimal("0.6"), quantities=[Decimal(10), Decimal(20)])
+    allocator = BudgetAllocator({'nano': 5})
+    allocator.track(1, wall)
+    allocator.track(2, wall)
+    assert(allocator.committed() == {'nano': (Decimal(16), Decimal(5))})
+    wall.record(buy(10, "4"))
+    allocator.track(1, wall)
+    allocator.forget(2)
+    assert(allocator.open_buys == {'nano': Decimal(4)} and allocator.committed() == {})
+    print("budget ok")
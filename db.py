@@ -1,29 +1,399 @@
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from decimal import Decimal, ROUND_HALF_EVEN
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
+from metrics import REGISTRY
 
 # Step 1: Establish a connection to the database
-db = SqliteDatabase('trading.sqlite')
+# The agent and the API write the same file from separate processes. WAL lets readers run while a write is in
+# progress, and busy_timeout makes a blocked writer wait for the lock instead of failing with "database is locked".
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 10000,
+    'temp_store': 'memory',
+}
+db_query_seconds = REGISTRY.histogram("db_query_seconds", "Time spent executing SQL statements")
+
+class TimedSqliteDatabase(SqliteDatabase):
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        with db_query_seconds.time():
+            return super().execute_sql(sql, params, *args, **kwargs)
+
+db = TimedSqliteDatabase(os.getenv('TRADING_DB', 'trading.sqlite'), pragmas=PRAGMAS, timeout=10)
 
 # Step 2: Define the models
+# Fixed-point scales. Prices keep 12 decimal places (up to ~9.2e6 per unit), amounts 8 (up to ~9.2e10 coins).
+PRICE_PLACES = 12
+AMOUNT_PLACES = 8
+
+class FixedDecimalField(BigIntegerField):
+    """
+    Stores a Decimal as an integer number of 10**-decimal_places units, so SQLite can sum, compare and index it.
+    Values are rounded half-even to decimal_places on write and read back as Decimal.
+    """
+    def __init__(self, decimal_places=AMOUNT_PLACES, *args, **kwargs):
+        self.decimal_places = decimal_places
+        self.unit = Decimal(1).scaleb(-decimal_places)
+        super().__init__(*args, **kwargs)
+
+    def round(self, value):
+        if isinstance(value, float):
+            value = str(value)
+        return Decimal(value).quantize(self.unit, rounding=ROUND_HALF_EVEN)
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        scaled = int(self.round(value).scaleb(self.decimal_places))
+        if abs(scaled) >= 2 ** 63:
+            raise ValueError("%s is out of range for %d decimal places" % (value, self.decimal_places))
+        return scaled
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return Decimal(int(value)).scaleb(-self.decimal_places)
+
+class LadderField(TextField):
+    """
+    Stores a list of Decimals, such as the quantities of a wall's levels, in one column as comma separated integers
+    of 10**-decimal_places units, rounded like FixedDecimalField. An empty list is stored as NULL.
+    """
+    def __init__(self, decimal_places=AMOUNT_PLACES, *args, **kwargs):
+        self.units = FixedDecimalField(decimal_places)
+        super().__init__(*args, **kwargs)
+
+    def db_value(self, value):
+        if not value:
+            return None
+        return ",".join(str(self.units.db_value(item)) for item in value)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return [self.units.python_value(item) for item in value.split(",")]
+
+def decimal_str(value):
+    """Formats a Decimal read from a FixedDecimalField without trailing zeros or exponent, e.g. "0.4"."""
+    return format(value.normalize(), 'f')
+
 class BaseModel(Model):
     class Meta:
         database = db
 
 class Wall(BaseModel):
-    bid_price = CharField()
-    keep = CharField(default="0")
-    ask_price = CharField()
-    quantity = CharField()
-    pair = CharField()
+    bid_price = FixedDecimalField(PRICE_PLACES)
+    keep = FixedDecimalField(AMOUNT_PLACES, default=0)
+    ask_price = FixedDecimalField(PRICE_PLACES)
+    quantity = FixedDecimalField(AMOUNT_PLACES)
+    pair = CharField(index=True)
+    # Set on every save so caches of built walls can tell when a row changed. Bulk Wall.update() queries must set it too.
+    version = IntegerField(default=0)
+    # A ladder's level quantities, starting with quantity; NULL for a wall of one level. Level n buys at
+    # bid_price / spread**n and sells at ask_price * spread**n.
+    quantities = LadderField(AMOUNT_PLACES, null=True)
+    spread = FixedDecimalField(AMOUNT_PLACES, default=2)
+
+    def levels(self):
+        """Returns the quantity of each level."""
+        return self.quantities or [self.quantity]
+
+    def save(self, *args, **kwargs):
+        # Nanoseconds rather than a counter so a row recreated under a reused id never matches an old cached version
+        self.version = time.time_ns()
+        return super().save(*args, **kwargs)
 
 class OrderExecution(BaseModel):
     TYPE_CHOICES = (('buy', 'buy'), ('sell', 'sell'))
 
     type = CharField(choices=TYPE_CHOICES)
+    created_at = DateTimeField(constraints=[SQL('DEFAULT CURRENT_TIMESTAMP')], index=True)
+    amount = FixedDecimalField(AMOUNT_PLACES)
+    total_price = FixedDecimalField(AMOUNT_PLACES)
+    wall = ForeignKeyField(Wall, backref='executions', index=True)
+
+class WallSummary(BaseModel):
+    """
+    Running totals of a wall's executions, updated in the same transaction as each OrderExecution insert.
+    """
+    wall = ForeignKeyField(Wall, backref='summaries', unique=True)
+    holdings = FixedDecimalField(AMOUNT_PLACES, default=0)
+    total_bought = FixedDecimalField(AMOUNT_PLACES, default=0)
+    total_sold = FixedDecimalField(AMOUNT_PLACES, default=0)
+    bought_value = FixedDecimalField(AMOUNT_PLACES, default=0)
+    sold_value = FixedDecimalField(AMOUNT_PLACES, default=0)
+    fills = IntegerField(default=0)
+    # The wall's latest execution, which decides whether a wall with a selloff sells part of its last buy
+    last_type = CharField(null=True)
+    last_amount = FixedDecimalField(AMOUNT_PLACES, null=True)
+    last_total_price = FixedDecimalField(AMOUNT_PLACES, null=True)
+
+    @classmethod
+    def changes(cls, type, amount, total_price):
+        """
+        Returns the per-field increments a single execution makes, for use in apply() or an UPDATE.
+        """
+        if type == 'buy':
+            return {'holdings': amount, 'total_bought': amount, 'bought_value': total_price, 'fills': 1}
+        return {'holdings': -amount, 'total_sold': amount, 'sold_value': total_price, 'fills': 1}
+
+    def apply(self, type, amount, total_price):
+        amount = OrderExecution.amount.round(amount)
+        total_price = OrderExecution.total_price.round(total_price)
+        for field, delta in self.changes(type, amount, total_price).items():
+            setattr(self, field, Decimal(getattr(self, field)) + delta)
+        self.last_type = type
+        self.last_amount = amount
+        self.last_total_price = total_price
+
+    def cash_flow(self):
+        """
+        Returns the quote coin received from sells minus that spent on buys. Not realized profit: the cost of the
+        coins still held is counted too.
+        """
+        return self.sold_value - self.bought_value
+
+class Outbox(BaseModel):
+    """
+    Notifications waiting for delivery, written in the same transaction as the OrderExecution they announce.
+    A row is pending until delivered_at is set. claimed_until keeps a row from being sent by two workers at once
+    and delays the next attempt after a failed one.
+    """
+    execution = ForeignKeyField(OrderExecution, backref='notifications', null=True, unique=True)
+    message = TextField()
     created_at = DateTimeField(constraints=[SQL('DEFAULT CURRENT_TIMESTAMP')])
-    amount = CharField()
-    total_price = CharField()
-    wall = ForeignKeyField(Wall, backref='executions')
+    attempts = IntegerField(default=0)
+    claimed_until = FloatField(null=True)
+    delivered_at = DateTimeField(null=True, index=True)
+
+def record_execution(wall, type, amount, total_price, notification=None):
+    """
+    Inserts an OrderExecution and updates the wall's WallSummary atomically. If notification is given, it is queued
+    in the Outbox in the same transaction, so the fill and its alert are stored together or not at all.
+    """
+    # IMMEDIATE takes the write lock up front, so a concurrent writer waits on busy_timeout instead of failing
+    # when a read transaction tries to upgrade to a write.
+    amount = OrderExecution.amount.round(amount)
+    total_price = OrderExecution.total_price.round(total_price)
+    changes = WallSummary.changes(type, amount, total_price)
+    with db.atomic('IMMEDIATE'):
+        execution = OrderExecution.create(wall=wall, amount=amount, total_price=total_price, type=type)
+        # Increment in SQL rather than read-modify-write; create the row on the wall's first execution
+        values = {getattr(WallSummary, field): getattr(WallSummary, field) + delta for field, delta in changes.items()}
+        values.update({WallSummary.last_type: type, WallSummary.last_amount: amount, WallSummary.last_total_price: total_price})
+        updated = WallSummary.update(values).where(WallSummary.wall == wall).execute()
+        if not updated:
+            WallSummary.create(wall=wall, last_type=type, last_amount=amount, last_total_price=total_price, **changes)
+        if notification is not None:
+            Outbox.create(execution=execution, message=notification)
+    return execution
+
+def claim_outbox(limit=50, lease=60):
+    """
+    Claims up to limit pending notifications, oldest first, for lease seconds. Rows claimed by another worker
+    whose lease has not expired, or waiting for a retry, are skipped.
+    """
+    now = time.time()
+    available = Outbox.delivered_at.is_null() & (Outbox.claimed_until.is_null() | (Outbox.claimed_until <= now))
+    with db.atomic('IMMEDIATE'):
+        rows = list(Outbox.select().where(available).order_by(Outbox.id).limit(limit))
+        if rows:
+            Outbox.update(claimed_until=now + lease, attempts=Outbox.attempts + 1).where(Outbox.id.in_([row.id for row in rows])).execute()
+    return rows
+
+def complete_outbox(ids, retry_at=None):
+    """
+    Marks claimed notifications delivered, or, with retry_at (a time.time() value), releases them for another
+    attempt at that time. Rows already delivered are left untouched.
+    """
+    if retry_at is None:
+        values = {Outbox.delivered_at: datetime.datetime.now(), Outbox.claimed_until: None}
+    else:
+        values = {Outbox.claimed_until: retry_at}
+    with db.atomic('IMMEDIATE'):
+        for batch in chunked(list(ids), 500):
+            Outbox.update(values).where(Outbox.id.in_(batch) & Outbox.delivered_at.is_null()).execute()
+
+def create_walls(rows):
+    """
+    Inserts wall rows, given as dicts of Wall fields, in one transaction with batched multi-row inserts.
+    Returns the new ids in the order of rows.
+    """
+    ids = []
+    version = time.time_ns()
+    with db.atomic('IMMEDIATE'):
+        for batch in chunked([dict(row, version=version) for row in rows], 100):
+            ids += [wall.id for wall in Wall.insert_many(batch).returning(Wall.id).execute()]
+    return ids
+
+def update_walls(rows):
+    """
+    Updates wall rows, given as dicts of Wall fields including id, in one transaction with batched updates.
+    """
+    version = time.time_ns()
+    walls = [Wall(**dict(row, version=version)) for row in rows]
+    fields = sorted({field for row in rows for field in row if field != 'id'} | {'version'})
+    with db.atomic('IMMEDIATE'):
+        Wall.bulk_update(walls, fields=[getattr(Wall, field) for field in fields], batch_size=100)
+
+def delete_walls(ids):
+    """
+    Deletes walls together with their executions and summaries, one DELETE statement per table.
+    Their pending notifications stay in the Outbox.
+    """
+    ids = list(ids)
+    with db.atomic('IMMEDIATE'):
+        for batch in chunked(ids, 500):
+            WallSummary.delete().where(WallSummary.wall.in_(batch)).execute()
+            # Alerts for fills of a deleted wall are still delivered
+            executions = OrderExecution.select(OrderExecution.id).where(OrderExecution.wall.in_(batch))
+            Outbox.update(execution=None).where(Outbox.execution.in_(executions)).execute()
+            OrderExecution.delete().where(OrderExecution.wall.in_(batch)).execute()
+            Wall.delete().where(Wall.id.in_(batch)).execute()
+
+def rebuild_summaries(check=False):
+    """
+    Recomputes every WallSummary from OrderExecution.
+
+    Parameters:
+    - check (bool): Only report walls whose stored summary differs from the recomputed one, without writing.
+
+    Returns:
+    - A list of ids of walls whose summary had drifted.
+    """
+    fields = ['holdings', 'total_bought', 'total_sold', 'bought_value', 'sold_value', 'fills', 'last_type', 'last_amount', 'last_total_price']
+    drifted = []
+    with db.atomic('DEFERRED' if check else 'IMMEDIATE'):
+        expected = {wall_id: WallSummary(wall=wall_id) for wall_id, in Wall.select(Wall.id).tuples()}
+        # The amounts are integers in SQLite, so the totals are summed there in one grouped query
+        totals = (OrderExecution
+                  .select(OrderExecution.wall, OrderExecution.type, fn.SUM(OrderExecution.amount), fn.SUM(OrderExecution.total_price), fn.COUNT(OrderExecution.id))
+                  .group_by(OrderExecution.wall, OrderExecution.type)
+                  .tuples())
+        for wall_id, type, amount, total_price, count in totals:
+            if wall_id not in expected:
+                continue
+            summary = expected[wall_id]
+            changes = WallSummary.changes(type, OrderExecution.amount.python_value(amount), OrderExecution.total_price.python_value(total_price))
+            changes['fills'] = count
+            for field, delta in changes.items():
+                setattr(summary, field, getattr(summary, field) + delta)
+        latest = OrderExecution.select(fn.MAX(OrderExecution.id)).group_by(OrderExecution.wall)
+        last = OrderExecution.select(OrderExecution.wall, OrderExecution.type, OrderExecution.amount, OrderExecution.total_price).where(OrderExecution.id.in_(latest))
+        for wall_id, type, amount, total_price in last.tuples():
+            if wall_id in expected:
+                expected[wall_id].last_type = type
+                expected[wall_id].last_amount = amount
+                expected[wall_id].last_total_price = total_price
+
+        stored = {summary.wall_id: summary for summary in WallSummary.select()}
+        for wall_id, summary in expected.items():
+            current = stored.get(wall_id)
+            if current is None or any(getattr(current, field) != getattr(summary, field) for field in fields):
+                drifted.append(wall_id)
+                if not check:
+                    if current is not None:
+                        summary.id = current.id
+                    summary.save(force_insert=current is None)
+    return drifted
+
+def migrate_fixed_point():
+    """
+    Converts databases that stored prices and amounts as text into FixedDecimalField integer columns.
+    A copy of the database is saved next to it first. Runs inside init_db()'s transaction, so the columns are
+    checked and converted under the same write lock and a concurrent process sees either format, never half of each.
+    """
+    models = [model for model in (Wall, OrderExecution, WallSummary) if model.table_exists()]
+    stale = []
+    for model in models:
+        types = {column.name: column.data_type.upper() for column in db.get_columns(model._meta.table_name)}
+        if any(isinstance(field, FixedDecimalField) and 'INT' not in types.get(field.column_name, 'INT') for field in model._meta.sorted_fields):
+            stale.append(model)
+    if not stale:
+        return
+
+    if db.database != ':memory:':
+        backup = "%s.%d.bak" % (db.database, time.time())
+        logging.getLogger(__name__).warning("converting prices and amounts to fixed-point columns, saving a copy to %s", backup)
+        # VACUUM can't run inside a transaction; a second connection can still read the file while this one holds
+        # the write lock, and sees it as it was before the transaction
+        source = sqlite3.connect(db.database)
+        try:
+            source.execute("VACUUM INTO ?", (backup,))
+        finally:
+            source.close()
+    for model in stale:
+        types = {column.name: column.data_type.upper() for column in db.get_columns(model._meta.table_name)}
+        fields = [field for field in model._meta.sorted_fields if field.column_name in types]
+        # Columns added since, such as Wall.spread, already hold units; only the text ones are parsed as Decimals
+        parse = [str if 'INT' not in types[field.column_name] else field.python_value for field in fields]
+        columns = ", ".join('"%s"' % field.column_name for field in fields)
+        rows = db.execute_sql('SELECT %s FROM "%s"' % (columns, model._meta.table_name)).fetchall()
+        db.execute_sql('DROP TABLE "%s"' % model._meta.table_name)
+        model.create_table()
+        for batch in chunked(rows, 100):
+            model.insert_many([[convert(value) if isinstance(field, FixedDecimalField) and value is not None else value for field, convert, value in zip(fields, parse, row)] for row in batch], fields=fields).execute()
+    if WallSummary in models:
+        # Totals summed from unrounded text differ from sums of the rounded executions in the last place
+        rebuild_summaries()
 
 # Step 3: Create the tables
-db.connect()
-db.create_tables([Wall, OrderExecution])
+# Not done on import: processes call init_db() once at startup, so importing db for its models stays cheap
+initialized = False
+init_lock = threading.Lock()
+
+def init_db():
+    """
+    Creates missing tables and upgrades databases written by earlier versions: adds the version, ladder and latest
+    execution columns, converts text prices and amounts to fixed point and backfills WallSummary. Only the first call in a process does
+    any work.
+
+    The agent and the API may start together on the same file, so the schema is inspected and upgraded in one
+    IMMEDIATE transaction: the second process waits for the write lock and then finds the upgrade already done.
+    """
+    global initialized
+    with init_lock:
+        if initialized:
+            return
+        db.connect(reuse_if_open=True)
+        with db.atomic('IMMEDIATE'):
+            summaries_exist = WallSummary.table_exists()
+            backfill = not summaries_exist
+            if summaries_exist:
+                columns = [column.name for column in db.get_columns('wallsummary')]
+                for field in (WallSummary.last_type, WallSummary.last_amount, WallSummary.last_total_price):
+                    if field.column_name not in columns:
+                        migrate(SqliteMigrator(db).add_column('wallsummary', field.column_name, field))
+                        backfill = True
+            if Wall.table_exists():
+                columns = [column.name for column in db.get_columns('wall')]
+                for field in (Wall.version, Wall.quantities, Wall.spread):
+                    if field.column_name not in columns:
+                        migrate(SqliteMigrator(db).add_column('wall', field.column_name, field))
+            migrate_fixed_point()
+            db.create_tables([Wall, OrderExecution, WallSummary, Outbox])
+            if backfill:
+                # Databases created before WallSummary or its latest execution columns existed are backfilled once
+                rebuild_summaries()
+        initialized = True
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in ('init', 'check', 'rebuild'):
+        print("Usage: python db.py init|check|rebuild")
+        sys.exit(1)
+    init_db()
+    if command == 'init':
+        sys.exit(0)
+    drifted = rebuild_summaries(check=command == 'check')
+    print(("Drifted" if command == 'check' else "Rebuilt"), "summaries for", len(drifted), "walls", drifted)
+    sys.exit(1 if command == 'check' and drifted else 0)
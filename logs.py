@@ -0,0 +1,164 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Attributes every LogRecord has; anything else on a record came from extra= and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+def record_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES}
+
+def field_text(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="'):
+        return json.dumps(text)
+    return text
+
+class TextFormatter(logging.Formatter):
+    """
+    One line per record: time, level, logger, message, then the extra fields as key=value pairs.
+
+    Example Output:
+    2024-05-01 12:00:00,123 INFO  trade_agent fill pair=near/nano wall=3 type=buy amount=10 price=0.35
+    """
+    def format(self, record):
+        line = "%s %-5s %s %s" % (self.formatTime(record), record.levelname, record.name, record.getMessage())
+        fields = record_fields(record)
+        if fields:
+            line += " " + " ".join("%s=%s" % (key, field_text(value)) for key, value in fields.items())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with ts, level, logger, message and the extra fields.
+    """
+    def format(self, record):
+        entry = {'ts': record.created, 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update(record_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a bounded queue for a QueueListener thread to format and write. The calling thread only
+    merges the message arguments; when the queue is full the record is dropped and counted instead of waiting.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+listener = None
+# Libraries that log every SQL statement or connection at DEBUG; the agent's DEBUG output is about walls
+QUIET_LOGGERS = ('peewee', 'urllib3')
+
+def setup_logging(level='INFO', format='text', stream=None, max_queue=10000):
+    """
+    Sends every logger's records through a NonBlockingQueueHandler to a background thread writing to stream.
+
+    Parameters:
+    - level (str or int): Records below this level are discarded before any formatting.
+    - format (str): 'text' for key=value lines or 'json' for one JSON object per line.
+    - stream (file, optional): Defaults to stderr.
+    - max_queue (int): Records buffered before new ones are dropped.
+
+    Returns:
+    - The queue handler, whose dropped attribute counts records lost to a full queue.
+    """
+    global listener
+    stop_logging()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if format == 'json' else TextFormatter())
+    handler = NonBlockingQueueHandler(queue.Queue(max_queue))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(root.level, logging.INFO))
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    return handler
+
+@atexit.register
+def stop_logging():
+    # Writes out the records still queued
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+class Sampler:
+    def __init__(self, interval, clock=time.monotonic):
+        """
+        Lets one record per key through every interval seconds, e.g. one status line per wall every 5 minutes.
+        An interval of 0 lets every record through.
+        """
+        self.interval = interval
+        self.clock = clock
+        self.last = {}
+
+    def allow(self, key):
+        if self.interval <= 0:
+            return True
+        now = self.clock()
+        last = self.last.get(key)
+        if last is not None and now - last < self.interval:
+            return False
+        self.last[key] = now
+        return True
+
+if __name__ == '__main__':
+    import io
+
+    stream = io.StringIO()
+    handler = setup_logging('INFO', stream=stream)
+    logger = logging.getLogger("check")
+    logger.debug("hidden %s", "debug")
+    logger.info("fill", extra={'pair': "near/nano", 'amount': 10, 'note': "two words"})
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception("failed")
+    stop_logging()
+    lines = stream.getvalue().splitlines()
+    assert("hidden" not in stream.getvalue())
+    assert(lines[0].endswith('INFO  check fill pair=near/nano amount=10 note="two words"'))
+    assert(lines[1].endswith("ERROR check failed") and "ZeroDivisionError" in stream.getvalue())
+
+    stream = io.StringIO()
+    setup_logging('DEBUG', format='json', stream=stream)
+    logger.debug("step", extra={'wall': 3})
+    stop_logging()
+    entry = json.loads(stream.getvalue())
+    assert((entry['level'], entry['logger'], entry['message'], entry['wall']) == ("DEBUG", "check", "step", 3))
+
+    times = iter([0, 10, 301, 302])
+    sampler = Sampler(300, clock=lambda: next(times))
+    assert([sampler.allow(1), sampler.allow(1), sampler.allow(1), sampler.allow(2)] == [True, False, True, True])
+    print("logs ok")
@@ -0,0 +1,236 @@
+import bisect
+import threading
+import time
+
+# Seconds, from a fast step() call up to a slow price fetch
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+def label_text(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs) + "}"
+
+class Counter:
+    """
+    Monotonic count per label set, e.g. fills by type.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def take(self):
+        """Returns the counts and starts again from zero."""
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + label_text(self.labelnames, key), value) for key, value in sorted(self.values.items())]
+
+class Histogram:
+    """
+    Distribution of observed values per label set, in cumulative buckets like a Prometheus histogram.
+
+    Example Usage:
+    step_seconds = REGISTRY.histogram("step_seconds", "Time spent in Walls.step()")
+    with step_seconds.time():
+        wall.step(price)
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket counts, accumulated when rendered, then sum and count
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def count(self, **labels):
+        state = self.values.get(tuple(labels[name] for name in self.labelnames))
+        return state[2] if state else 0
+
+    def take(self):
+        """Returns the observations and starts again from none."""
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for key, (counts, total, count) in values.items():
+                state = self.values.get(key)
+                if state is None:
+                    state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + "_bucket" + label_text(self.labelnames, key, [('le', bound)]), cumulative))
+                samples.append((self.name + "_sum" + label_text(self.labelnames, key), total))
+                samples.append((self.name + "_count" + label_text(self.labelnames, key), count))
+        return samples
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Registry:
+    def __init__(self):
+        """
+        The metrics of one process, rendered in the Prometheus text exposition format.
+        Asking for a metric name that is already registered returns the existing metric.
+        """
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help, labelnames=(), **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def take(self):
+        """
+        Returns what every metric recorded since the last take() and resets them, as picklable tuples that merge()
+        adds to another registry, e.g. to report a worker process's metrics from the process that serves them.
+        """
+        taken = []
+        for name, metric in sorted(self.metrics.items()):
+            values = metric.take()
+            if values:
+                taken.append((metric.kind, name, metric.help, metric.labelnames, getattr(metric, 'buckets', None), values))
+        return taken
+
+    def merge(self, taken):
+        for kind, name, help, labelnames, buckets, values in taken:
+            if kind == 'histogram':
+                metric = self.histogram(name, help, labelnames, buckets=buckets)
+            else:
+                metric = self.counter(name, help, labelnames)
+            metric.merge(values)
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append("# HELP %s %s" % (name, metric.help))
+            lines.append("# TYPE %s %s" % (name, metric.kind))
+            lines += ["%s %s" % (sample, repr(float(value)) if isinstance(value, float) else value) for sample, value in metric.samples()]
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serves registry on http://host:port/metrics from a background thread. Returns the server.
+    """
+    # Imported here: only the processes that serve metrics need http.server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    import urllib.request
+
+    registry = Registry()
+    fills = registry.counter("fills_total", "Fills recorded", ["type"])
+    fills.inc(type="buy")
+    fills.inc(2, type="sell")
+    step_seconds = registry.histogram("step_seconds", "Time in step()", buckets=(0.001, 0.01))
+    for value in (0.0005, 0.005, 0.5):
+        step_seconds.observe(value)
+    with step_seconds.time():
+        pass
+    assert(registry.counter("fills_total", "Fills recorded", ["type"]) is fills)
+
+    # Another process's metrics add up with this one's; take() leaves the worker's at zero
+    worker = Registry()
+    worker.counter("fills_total", "Fills recorded", ["type"]).inc(3, type="buy")
+    worker.histogram("step_seconds", "Time in step()", buckets=(0.001, 0.01)).observe(0.002)
+    worker.histogram("batch_seconds", "Time per batch").observe(0.2)
+    registry.merge(worker.take())
+    assert(worker.take() == [] and fills.value(type="buy") == 4 and registry.metrics["batch_seconds"].count() == 1)
+
+    server = serve(0, registry=registry)
+    text = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % server.server_address[1]).read().decode()
+    server.shutdown()
+    assert('fills_total{type="buy"} 4' in text and 'fills_total{type="sell"} 2' in text)
+    assert('step_seconds_bucket{le="0.001"} 2' in text and 'step_seconds_bucket{le="0.01"} 4' in text)
+    assert('step_seconds_bucket{le="+Inf"} 5' in text and "step_seconds_count 5" in text)
+    print(text)
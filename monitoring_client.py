@@ -28,4 +28,4 @@ class MonitoringClient:
     def send_alert(self, error_message):
         subject = "Trading Bot Alert"
         message = f"An error occurred in the trading bot:\n\n{error_message}"
-        notification(subject, message)
+        notification(subject + "\n" + message)
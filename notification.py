@@ -1,5 +1,182 @@
+import atexit
+import logging
 import os
-import requests
+import queue
+import random
+import threading
+import time
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+notifications_total = REGISTRY.counter("notifications_total", "Notifications by outcome: sent, dropped after retries or a full queue, or failed and left for retry", ["result"])
+
+class NotificationDispatcher:
+    def __init__(self, webhook_url, max_queue=1000, batch_window=1.0, min_interval=1.0, max_digest=50, timeout=5, max_retries=5, retry_delay=1):
+        """
+        Delivers webhook notifications from a background thread so a slow or failing webhook never holds up trading.
+
+        Messages wait in a bounded queue. The worker collects the messages that arrive within batch_window seconds
+        of the first one, such as the fills of one price update, and posts them as a single digest. Posts go over one
+        pooled session, at most one per min_interval seconds, the rate Slack allows for incoming webhooks. Timeouts,
+        connection errors, 5xx and 429 responses are retried with exponential backoff and full jitter; a 429's
+        Retry-After is waited out first.
+
+        Parameters:
+        - webhook_url (str): Where digests are posted as {"text": ...}.
+        - max_queue (int): Messages held before submit() starts dropping new ones.
+        - batch_window (float): Seconds to wait for more messages before posting a digest.
+        - min_interval (float): Minimum seconds between two posts.
+        - max_digest (int): Most messages in one digest; the rest go in the next one.
+        - timeout (float): Seconds allowed per post.
+        - max_retries (int): Attempts per digest before it is dropped.
+        - retry_delay (float): Base delay in seconds; attempt n waits up to retry_delay * 2**n.
+
+        Example Usage:
+        dispatcher = NotificationDispatcher(os.getenv('WEBHOOK_URL'))
+        dispatcher.submit("Trade Walls: buy near/nano ...")
+        dispatcher.flush(timeout=10)
+        """
+        self.webhook_url = webhook_url
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_window = batch_window
+        self.min_interval = min_interval
+        self.max_digest = max_digest
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Imported here so importing notification, e.g. through MonitoringClient, doesn't load requests
+        import requests
+        self.session = requests.Session()
+        self.condition = threading.Condition()
+        self.post_lock = threading.Lock()
+        self.pending = 0
+        self.sent = 0
+        self.dropped = 0
+        self.posts = 0
+        self.last_post = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="notification-dispatcher", daemon=True)
+            self.thread.start()
+        return self
+
+    def submit(self, message):
+        """
+        Queues message for delivery without blocking. Returns False if the queue is full and the message was dropped.
+        """
+        with self.condition:
+            self.pending += 1
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self._done(1, sent=False)
+            logger.error("notification queue is full, dropping message", extra={'text': message})
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued message has been delivered or dropped. Returns False on timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending == 0, timeout)
+
+    def _done(self, count, sent):
+        with self.condition:
+            self.pending -= count
+            if sent:
+                self.sent += count
+            else:
+                self.dropped += count
+            notifications_total.inc(count, result='sent' if sent else 'dropped')
+            self.condition.notify_all()
+
+    def _collect(self):
+        messages = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(messages) < self.max_digest:
+            remaining = deadline - time.monotonic()
+            try:
+                messages.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def _run(self):
+        while True:
+            messages = self._collect()
+            sent = False
+            try:
+                sent = self.post(digest(messages))
+            except Exception as e:
+                logger.exception("notification dispatcher error")
+            self._done(len(messages), sent)
+
+    def post(self, text):
+        """
+        Posts text right away, respecting min_interval and retrying like queued digests do. Returns True once the
+        webhook accepted it. For callers that batch on their own, such as OutboxWorker.
+        """
+        with self.post_lock:
+            return self._post(text)
+
+    def _post(self, text):
+        import requests
+        attempt = 0
+        while True:
+            if self.last_post is not None:
+                time.sleep(max(0, self.last_post + self.min_interval - time.monotonic()))
+            self.last_post = time.monotonic()
+            self.posts += 1
+            retry_after = 0
+            try:
+                response = self.session.post(self.webhook_url, json={"text": text}, timeout=self.timeout)
+                if response.status_code == 200:
+                    logger.debug("notification sent", extra={'attempts': attempt + 1})
+                    return True
+                if response.status_code != 429 and response.status_code < 500:
+                    logger.error("webhook rejected notification", extra={'status': response.status_code, 'response': response.text})
+                    return False
+                error = f"status code {response.status_code}"
+                if response.status_code == 429:
+                    retry_after = float(response.headers.get('Retry-After', 0))
+            except requests.RequestException as e:
+                error = str(e)
+            attempt += 1
+            if attempt >= self.max_retries:
+                logger.error("giving up on notification", extra={'attempts': attempt, 'error': error})
+                return False
+            delay = retry_after + random.uniform(0, self.retry_delay * 2 ** attempt)
+            logger.warning("webhook call failed, retrying", extra={'error': error, 'delay': round(delay, 2)})
+            time.sleep(delay)
+
+def digest(messages):
+    """
+    Joins the messages of one batch into a single webhook text.
+    """
+    if len(messages) == 1:
+        return messages[0]
+    return "%d notifications\n" % len(messages) + "\n".join(messages)
+
+dispatchers = {}
+dispatchers_lock = threading.Lock()
+
+def get_dispatcher(webhook_url):
+    """
+    Returns the running dispatcher for webhook_url, starting it on first use. Queued messages are flushed at exit.
+    """
+    with dispatchers_lock:
+        if webhook_url not in dispatchers:
+            dispatchers[webhook_url] = NotificationDispatcher(webhook_url).start()
+        return dispatchers[webhook_url]
+
+@atexit.register
+def flush_dispatchers(timeout=10):
+    for dispatcher in list(dispatchers.values()):
+        dispatcher.flush(timeout)
 
 def notification(message):
     """
@@ -8,6 +185,9 @@ def notification(message):
     This function is designed for versatility, supporting messaging through webhooks
     (e.g., Slack) or simple stdout output for logging or testing.
 
+    Webhook messages are handed to a background NotificationDispatcher and this
+    function returns right away; messages sent close together arrive as one digest.
+
     Parameters:
     - message (str): The notification message to send.
 
@@ -19,20 +199,58 @@ def notification(message):
     webhook_url = os.getenv('WEBHOOK_URL')
 
     if webhook_url:
-        print("Calling webhook with message:", message)
-        # If WEBHOOK_URL is set, prepare and send the message as a JSON payload
-        payload = {"text": message}
-        response = requests.post(webhook_url, json=payload)
-        # Check the response to determine if the POST was successful
-        if response.status_code == 200:
-            print("Notification sent successfully to webhook.")
-        else:
-            print(f"Failed to send notification to webhook. Status code: {response.status_code}, Response: {response.text}")
+        logger.debug("queueing notification", extra={'text': message})
+        get_dispatcher(webhook_url).submit(message)
     else:
         # If no webhook URL is found, output the message to stdout
         print("Notification message (environment variable webhook URL provided):")
         print(message)
 
 if __name__ == '__main__':
-    notification("Testing notify")
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+    posts = []
+    responses = [(429, {'Retry-After': '0.2'}), (500, {})]
+
+    class FakeWebhook(BaseHTTPRequestHandler):
+        def do_POST(self):
+            posts.append((time.monotonic(), json.loads(self.rfile.read(int(self.headers['Content-Length'])))['text']))
+            status, headers = responses.pop(0) if responses else (200, {})
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeWebhook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/hook" % server.server_address[1]
+
+    dispatcher = NotificationDispatcher(url, batch_window=0.2, min_interval=0.3, retry_delay=0.01).start()
+    started = time.monotonic()
+    for i in range(5):
+        assert(dispatcher.submit("fill %d" % i))
+    assert(time.monotonic() - started < 0.1)
+    assert(dispatcher.flush(timeout=10))
+    # One digest of all five fills, retried after a 429 and a 500
+    assert([text for _, text in posts] == ["5 notifications\nfill 0\nfill 1\nfill 2\nfill 3\nfill 4"] * 3)
+    # Compared with some slack, the timestamps are taken by the server when each post arrives
+    assert(posts[1][0] - posts[0][0] >= 0.15)
+    dispatcher.submit("fill 5")
+    assert(dispatcher.flush(timeout=10))
+    assert(posts[-1][1] == "fill 5" and posts[-1][0] - posts[-2][0] >= 0.25)
+    assert((dispatcher.sent, dispatcher.dropped) == (6, 0))
+
+    # A full queue drops instead of blocking the caller
+    stopped = NotificationDispatcher(url, max_queue=2)
+    assert([stopped.submit(str(i)) for i in range(3)] == [True, True, False])
+    assert(stopped.dropped == 1)
+    server.shutdown()
+    print("notification ok", len(posts), "posts")
+
+    notification("Testing notify")
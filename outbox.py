@@ -0,0 +1,114 @@
+import logging
+import os
+import sys
+import threading
+import time
+from db import db, init_db, Outbox, claim_outbox, complete_outbox
+from notification import digest, get_dispatcher, notifications_total
+
+logger = logging.getLogger(__name__)
+
+class OutboxWorker:
+    def __init__(self, webhook_url=None, batch_size=50, poll_interval=5, lease=60, retry_delay=30):
+        """
+        Delivers the notifications record_execution queued in the Outbox table, from a background thread.
+
+        Pending rows are claimed in batches, posted as one digest through the webhook's NotificationDispatcher and
+        marked delivered only after the webhook accepted them. A batch that fails is released for another attempt
+        after retry_delay seconds, doubling per attempt. Rows left claimed by a worker that crashed are picked up
+        again once their lease expires, so after a restart every fill is announced. A crash between a successful
+        post and marking the rows delivered announces those fills twice; nothing is ever lost.
+
+        Parameters:
+        - webhook_url (str, optional): Defaults to the WEBHOOK_URL environment variable. Without one, notifications
+          are printed to stdout like notification() does.
+        - batch_size (int): Most notifications per digest.
+        - poll_interval (float): Seconds between checks for pending rows when nothing calls wake().
+        - lease (float): Seconds a claimed batch is reserved for this worker.
+        - retry_delay (float): Seconds before a failed batch is attempted again.
+
+        Example Usage:
+        worker = OutboxWorker().start()
+        record_execution(wall, 'buy', amount, total_price, notification="Trade Walls: buy ...")
+        worker.wake()
+        """
+        self.webhook_url = webhook_url if webhook_url is not None else os.getenv('WEBHOOK_URL')
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.event = threading.Event()
+        self.thread = None
+        self.delivered = 0
+        self.failed = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="outbox-worker", daemon=True)
+            self.thread.start()
+        return self
+
+    def wake(self):
+        """
+        Asks the worker to deliver right away instead of at its next poll.
+        """
+        self.event.set()
+
+    def send(self, messages):
+        if not self.webhook_url:
+            for message in messages:
+                print("Notification message (environment variable webhook URL provided):")
+                print(message)
+            return True
+        return get_dispatcher(self.webhook_url).post(digest(messages))
+
+    def drain(self):
+        """
+        Delivers pending notifications until none are left that can be sent now. Returns the number delivered.
+        """
+        delivered = 0
+        while True:
+            rows = claim_outbox(self.batch_size, self.lease)
+            if not rows:
+                return delivered
+            ids = [row.id for row in rows]
+            if self.send([row.message for row in rows]):
+                complete_outbox(ids)
+                delivered += len(rows)
+                self.delivered += len(rows)
+                notifications_total.inc(len(rows), result='sent')
+            else:
+                self.failed += len(rows)
+                notifications_total.inc(len(rows), result='failed')
+                attempts = max(row.attempts for row in rows) + 1
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                complete_outbox(ids, retry_at=time.time() + delay)
+                logger.warning("notification delivery failed", extra={'notifications': len(rows), 'attempts': attempts, 'retry_in': delay})
+                return delivered
+
+    def _run(self):
+        db.connect(reuse_if_open=True)
+        while True:
+            self.event.wait(self.poll_interval)
+            self.event.clear()
+            try:
+                self.drain()
+            except Exception as e:
+                logger.exception("outbox worker error")
+
+def pending():
+    """
+    Returns (pending, claimed): undelivered notifications, and how many of them are claimed by a worker or waiting
+    for a retry.
+    """
+    undelivered = Outbox.select().where(Outbox.delivered_at.is_null())
+    return undelivered.count(), undelivered.where(Outbox.claimed_until > time.time()).count()
+
+if __name__ == '__main__':
+    init_db()
+    delivered = OutboxWorker().drain()
+    remaining, claimed = pending()
+    print("Delivered", delivered, "notifications,", remaining, "still pending")
+    if claimed:
+        print(claimed, "are claimed by another worker or waiting for a retry; a crashed worker's claims expire after its lease")
+    sys.exit(0 if remaining == 0 else 1)
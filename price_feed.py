@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+COINGECKO_MARKETS_URL = "https://api.coingecko.com/api/v3/coins/markets?vs_currency=usd&ids="
+
+class PriceFeed:
+    def __init__(self, url=COINGECKO_MARKETS_URL, ttl=30, chunk_size=100, timeout=5, max_retries=3, retry_delay=1):
+        """
+        Fetches CoinGecko market details concurrently over one pooled HTTP session.
+
+        Large id lists are split into chunks fetched in parallel. Callers asking for an id that is already being
+        fetched share the in-flight request, and results are cached for ttl seconds. Failed requests are retried
+        with exponential backoff and full jitter. Ids CoinGecko doesn't return are cached as misses for ttl seconds
+        too, so an unknown or mistyped coin is asked for again once per ttl rather than on every poll.
+
+        Parameters:
+        - url (str): Markets endpoint; comma separated ids are appended to it. Point it at a local server to test.
+        - ttl (float): Seconds a fetched price stays fresh.
+        - chunk_size (int): Maximum number of ids per request.
+        - timeout (float): Total seconds allowed per request.
+        - max_retries (int): Attempts per chunk before the error is raised.
+        - retry_delay (float): Base delay in seconds; attempt n waits up to retry_delay * 2**n.
+
+        Example Usage:
+        feed = PriceFeed()
+        details = asyncio.run(feed.fetch(["near", "nano"]))
+        """
+        self.url = url
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.session = None
+        self.cache = {}
+        self.in_flight = {}
+        self.requests = 0
+
+    async def fetch(self, ids):
+        """
+        Returns the market details for ids, in the same format as the CoinGecko markets endpoint. Ids CoinGecko
+        does not know are left out, like the endpoint does.
+        """
+        if isinstance(ids, str):
+            ids = ids.split(",")
+        now = time.monotonic()
+        waiting = {}
+        missing = []
+        for coin in dict.fromkeys(ids):
+            cached = self.cache.get(coin)
+            if cached is not None and cached[0] > now:
+                continue
+            if coin in self.in_flight:
+                waiting[coin] = self.in_flight[coin]
+            else:
+                missing.append(coin)
+
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = missing[start:start + self.chunk_size]
+            task = asyncio.ensure_future(self._fetch_chunk(chunk))
+            for coin in chunk:
+                self.in_flight[coin] = task
+                waiting[coin] = task
+
+        if waiting:
+            await asyncio.gather(*set(waiting.values()))
+        return [self.cache[coin][1] for coin in dict.fromkeys(ids) if coin in self.cache and self.cache[coin][1] is not None]
+
+    async def _fetch_chunk(self, chunk):
+        try:
+            details = await self._get(self.url + ",".join(chunk))
+            expires = time.monotonic() + self.ttl
+            for coin in chunk:
+                self.cache[coin] = (expires, None)
+            for detail in details:
+                self.cache[detail['id']] = (expires, detail)
+        finally:
+            for coin in chunk:
+                self.in_flight.pop(coin, None)
+
+    async def _get(self, url):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(headers={'User-Agent': "trade_agent"}, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        attempt = 0
+        while True:
+            try:
+                self.requests += 1
+                async with self.session.get(url) as response:
+                    response.raise_for_status()
+                    return json.loads(await response.text())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, self.retry_delay * 2 ** attempt)
+                logger.warning("price request failed, retrying", extra={'error': str(e), 'delay': round(delay, 2)})
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+if __name__ == '__main__':
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    hits = []
+    failures = [1]
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            ids = parse_qs(urlparse(self.path).query)['ids'][0].split(",")
+            hits.append(ids)
+            time.sleep(0.05)
+            if failures[0] > 0:
+                failures[0] -= 1
+                self.send_response(503)
+                self.end_headers()
+                return
+            body = json.dumps([{'id': coin, 'current_price': len(coin)} for coin in ids if coin != "unknown"]).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/markets?vs_currency=usd&ids=" % server.server_address[1]
+
+    async def check():
+        feed = PriceFeed(url=url, ttl=60, chunk_size=2, retry_delay=0.01)
+        coins = ["near", "nano", "bitcoin", "unknown", "ethereum"]
+        first, second = await asyncio.gather(feed.fetch(coins), feed.fetch(["bitcoin", "near"]))
+        assert([d['id'] for d in first] == ["near", "nano", "bitcoin", "ethereum"])
+        assert([d['id'] for d in second] == ["bitcoin", "near"])
+        # three chunks plus one retried 503, and the concurrent caller shared the in-flight chunks
+        assert(len(hits) == 4)
+        await feed.fetch(coins[:3])
+        assert(len(hits) == 4)
+        # the unknown id is a cached miss, not fetched again within the ttl
+        assert([d['id'] for d in await feed.fetch(["unknown", "near"])] == ["near"])
+        assert(len(hits) == 4)
+        await feed.close()
+
+    asyncio.run(check())
+    server.shutdown()
+    print("price_feed ok", hits)
@@ -0,0 +1,201 @@
+import csv
+import datetime
+import time
+from decimal import Decimal
+
+class PriceSource:
+    """
+    A source of USD prices for coins, keyed by CoinGecko id.
+
+    quotes(coins) returns {coin: (price, timestamp)} for the coins it knows, with timestamp in epoch seconds.
+    Coins a source doesn't know are left out. A source may also quote pairs directly, keyed "lhs/rhs" with the price
+    of lhs in units of rhs; RateMatrix uses them to price coins that have no USD quote.
+    """
+    def quotes(self, coins):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def pair_price(quotes, pair):
+    """
+    Returns the price of the pair's first coin in units of its second, e.g. NEAR in NANO for "near/nano".
+    """
+    lhs, rhs = pair.split("/")
+    return Decimal(quotes[lhs][0]) / Decimal(quotes[rhs][0])
+
+class CoinGeckoSource(PriceSource):
+    def __init__(self, feed=None):
+        # Imported here so modules that only need the other sources or pair_price don't load aiohttp
+        import asyncio
+        from price_feed import PriceFeed
+        self.feed = feed or PriceFeed()
+        # One loop for the life of the source so the feed's pooled connection and cache survive between calls
+        self.loop = asyncio.new_event_loop()
+
+    def details(self, coins):
+        return self.loop.run_until_complete(self.feed.fetch(coins))
+
+    def quotes(self, coins):
+        now = time.time()
+        result = {}
+        # CoinGecko only has USD prices; pairs asked for are priced from those
+        for d in self.details([coin for coin in coins if "/" not in coin]):
+            timestamp = now
+            if d.get('last_updated'):
+                timestamp = datetime.datetime.fromisoformat(d['last_updated'].replace('Z', '+00:00')).timestamp()
+            result[d['id']] = (d['current_price'], timestamp)
+        return result
+
+    def close(self):
+        self.loop.run_until_complete(self.feed.close())
+
+def read_tape(path):
+    """
+    Reads a price tape with timestamp, coin and price columns from a CSV or Parquet file, sorted by timestamp.
+    """
+    if path.endswith('.parquet'):
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError("Replaying Parquet tapes requires pandas and pyarrow: pip install pandas pyarrow")
+        frame = pandas.read_parquet(path, columns=['timestamp', 'coin', 'price'])
+        rows = [(float(t), c, float(p)) for t, c, p in frame.itertuples(index=False)]
+    else:
+        with open(path, newline='') as f:
+            rows = [(float(row['timestamp']), row['coin'], float(row['price'])) for row in csv.DictReader(f)]
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+class ReplaySource(PriceSource):
+    def __init__(self, path, speed=None, clock=time.monotonic):
+        """
+        Plays back a recorded price tape.
+
+        Parameters:
+        - path (str): CSV or Parquet tape with timestamp, coin and price columns, as written by RecordingSource.
+          A coin like near/nano is a direct quote of that pair.
+        - speed (float, optional): Tape seconds played per wall clock second. Without one, every call to quotes()
+          advances to the next timestamp on the tape, as fast as the caller can go.
+        """
+        self.tape = read_tape(path)
+        self.speed = speed
+        self.clock = clock
+        self.position = 0
+        self.latest = {}
+        self.started = None
+
+    @property
+    def done(self):
+        return self.position >= len(self.tape)
+
+    def advance(self):
+        if self.done:
+            return
+        if self.speed is None:
+            target = self.tape[self.position][0]
+        else:
+            if self.started is None:
+                self.started = self.clock()
+            target = self.tape[0][0] + (self.clock() - self.started) * self.speed
+        while self.position < len(self.tape) and self.tape[self.position][0] <= target:
+            timestamp, coin, price = self.tape[self.position]
+            self.latest[coin] = (price, timestamp)
+            self.position += 1
+
+    def quotes(self, coins):
+        """
+        Returns the latest tape quotes of coins. A coin asked for without a USD price on the tape also brings the
+        direct pair quotes that chain it to coins with one, and their USD prices, so RateMatrix can price it.
+        """
+        self.advance()
+        result = {coin: self.latest[coin] for coin in coins if coin in self.latest}
+        unpriced = [coin for coin in coins if "/" not in coin and coin not in self.latest]
+        seen = set(unpriced)
+        while unpriced:
+            coin = unpriced.pop()
+            for key, quote in self.latest.items():
+                pair = key.split("/")
+                if len(pair) != 2 or coin not in pair:
+                    continue
+                result[key] = quote
+                other = pair[1] if pair[0] == coin else pair[0]
+                if other in self.latest:
+                    result[other] = self.latest[other]
+                elif other not in seen:
+                    seen.add(other)
+                    unpriced.append(other)
+        return result
+
+class CompositeSource(PriceSource):
+    def __init__(self, sources):
+        """
+        Asks every source and keeps the freshest quote per coin. A failing source is skipped as long as another
+        one answers.
+        """
+        self.sources = sources
+
+    def quotes(self, coins):
+        result = {}
+        errors = []
+        for source in self.sources:
+            try:
+                quotes = source.quotes(coins)
+            except Exception as e:
+                errors.append(e)
+                continue
+            for coin, quote in quotes.items():
+                if coin not in result or quote[1] > result[coin][1]:
+                    result[coin] = quote
+        if errors and len(errors) == len(self.sources):
+            raise errors[0]
+        return result
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+class RecordingSource(PriceSource):
+    def __init__(self, source, path):
+        """
+        Passes quotes through from source and appends them to a CSV tape that ReplaySource can play back.
+        """
+        self.source = source
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(['timestamp', 'coin', 'price'])
+
+    @property
+    def done(self):
+        return getattr(self.source, 'done', False)
+
+    def quotes(self, coins):
+        quotes = self.source.quotes(coins)
+        for coin, (price, timestamp) in quotes.items():
+            self.writer.writerow([repr(timestamp), coin, repr(price)])
+        self.file.flush()
+        return quotes
+
+    def close(self):
+        self.file.close()
+        self.source.close()
+
+class TimedSource(PriceSource):
+    def __init__(self, source, histogram):
+        """
+        Passes quotes through from source, observing the latency of every quotes() call in histogram.
+        """
+        self.source = source
+        self.histogram = histogram
+
+    @property
+    def done(self):
+        return getattr(self.source, 'done', False)
+
+    def quotes(self, coins):
+        with self.histogram.time():
+            return self.source.quotes(coins)
+
+    def close(self):
+        self.source.close()
@@ -0,0 +1,112 @@
+from collections import deque
+from decimal import Decimal
+
+class RateMatrix:
+    def __init__(self, quotes):
+        """
+        The exchange rates between the coins of one set of quotes, built once per price update and shared by every
+        wall and pair evaluated on it.
+
+        quotes is what PriceSource.quotes() returns: USD prices keyed by coin, and optionally direct pair quotes keyed
+        by "lhs/rhs", giving the price of lhs in units of rhs. A coin without a USD price gets one through a chain of
+        direct quotes to a coin that has one, so e.g. a "near/nano" quote and a NANO USD price are enough to trade
+        near against any other coin. Each pair's rate is divided out once and cached.
+
+        Parameters:
+        - quotes (dict): {coin or pair: (price, timestamp)}.
+
+        Example Usage:
+        rates = RateMatrix(price_source.quotes(coins))
+        for wall in walls:
+            unit_price = rates.rate(wall.pair)
+        """
+        self.direct = {}
+        self.usd = {}
+        for key, (price, _) in quotes.items():
+            if "/" in key:
+                self.direct[tuple(key.split("/"))] = Decimal(price)
+            else:
+                self.usd[key] = Decimal(price)
+        self.derived = self.derive()
+        self.cache = {}
+
+    def derive(self):
+        """
+        Prices coins that have no USD quote through the direct quotes, breadth first from the coins that do, so each
+        gets the shortest chain. Returns the coins priced this way.
+        """
+        links = {}
+        for (lhs, rhs), price in self.direct.items():
+            if price:
+                links.setdefault(lhs, []).append((rhs, price))
+                links.setdefault(rhs, []).append((lhs, 1 / price))
+        derived = set()
+        queue = deque(coin for coin in self.usd if coin in links)
+        while queue:
+            coin = queue.popleft()
+            for other, price in links[coin]:
+                # price is the value of one coin in units of other
+                if other not in self.usd:
+                    self.usd[other] = self.usd[coin] / price
+                    derived.add(other)
+                    queue.append(other)
+        return derived
+
+    def rate(self, pair):
+        """
+        Returns the price of the pair's first coin in units of its second as a Decimal, or None if the quotes can't
+        price it. A direct quote of the pair, or of its inverse, wins over a rate through USD.
+        """
+        if pair in self.cache:
+            return self.cache[pair]
+        lhs, rhs = pair.split("/")
+        rate = None
+        if (lhs, rhs) in self.direct:
+            rate = self.direct[(lhs, rhs)]
+        elif (rhs, lhs) in self.direct and self.direct[(rhs, lhs)]:
+            rate = 1 / self.direct[(rhs, lhs)]
+        elif lhs in self.usd and rhs in self.usd and self.usd[rhs]:
+            rate = self.usd[lhs] / self.usd[rhs]
+        self.cache[pair] = rate
+        return rate
+
+    def rates(self, pairs):
+        """
+        Returns {pair: rate} for the pairs the quotes can price.
+        """
+        rates = {}
+        for pair in pairs:
+            rate = self.rate(pair)
+            if rate is not None:
+                rates[pair] = rate
+        return rates
+
+    def matrix(self, coins=None):
+        """
+        Returns (coins, matrix): every cross rate between coins, or all priced coins, as a float array computed in
+        one vectorized division, where matrix[i, j] is the price of coins[i] in units of coins[j]. For analysis and
+        backtests; the agent trades on the exact Decimal rates from rate().
+        """
+        import numpy as np
+        coins = sorted(self.usd) if coins is None else [coin for coin in coins if coin in self.usd]
+        usd = np.array([float(self.usd[coin]) for coin in coins])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return coins, usd[:, None] / usd[None, :]
+
+if __name__ == '__main__':
+    from price_sources import pair_price
+
+    quotes = {'near': (5.25, 0), 'nano': (1.1, 0), 'bitcoin': (60000.0, 0), 'aurora/near': (0.02, 0), 'bitcoin/nano': (54000.0, 0)}
+    rates = RateMatrix(quotes)
+    # Through USD, exactly as pair_price divides
+    assert(rates.rate("near/nano") == pair_price(quotes, "near/nano"))
+    # A direct quote wins over USD, and prices its inverse
+    assert(rates.rate("bitcoin/nano") == Decimal(54000.0) and rates.rate("nano/bitcoin") == 1 / Decimal(54000.0))
+    # aurora has no USD price: 0.02 near at 5.25 USD each
+    assert(rates.derived == {'aurora'} and abs(rates.rate("aurora/nano") - Decimal("0.105") / Decimal("1.1")) < Decimal("1e-15"))
+    assert(rates.rate("near/unknown") is None and rates.rates(["near/nano", "near/unknown"]).keys() == {"near/nano"})
+    assert(rates.rate("near/nano") is rates.rate("near/nano"))
+
+    coins, matrix = rates.matrix(["near", "nano"])
+    assert(coins == ["near", "nano"] and abs(matrix[0, 1] - 5.25 / 1.1) < 1e-12 and matrix[1, 1] == 1)
+    print("rates ok")
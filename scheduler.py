@@ -0,0 +1,125 @@
+import heapq
+import logging
+import time
+from rates import RateMatrix
+
+logger = logging.getLogger(__name__)
+
+class LatencyStats:
+    """
+    Running count, mean, max and last of a latency in seconds.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return "n=%d last=%.2fms mean=%.2fms max=%.2fms" % (self.count, (self.last or 0) * 1000, self.mean() * 1000, self.max * 1000)
+
+class PairScheduler:
+    def __init__(self, price_source, on_update, intervals=None, default_interval=60, max_backoff=900, clock=time.monotonic, sleep=time.sleep):
+        """
+        Polls prices per pair and calls on_update only for pairs whose price changed.
+
+        Every pair has its own poll interval. Pairs that come due together are fetched in a single quotes() call.
+        When the source raises, or a pair's price is missing, that pair's interval doubles per consecutive failure
+        up to max_backoff and resets after the next success.
+
+        Parameters:
+        - price_source (PriceSource): Where quotes come from.
+        - on_update (callable): Called as on_update(pair, unit_price, received_at), with received_at the clock()
+          time the quotes arrived, so the callee can measure update-to-step latency.
+        - intervals (dict, optional): Poll interval in seconds per pair.
+        - default_interval (float): Poll interval in seconds for pairs not in intervals.
+        - max_backoff (float): Longest delay in seconds between polls of a failing pair.
+        """
+        self.price_source = price_source
+        self.on_update = on_update
+        self.intervals = intervals or {}
+        self.default_interval = default_interval
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.queue = []
+        self.pairs = set()
+        self.failures = {}
+        self.last_prices = {}
+
+    def interval(self, pair):
+        return self.intervals.get(pair, self.default_interval)
+
+    def sync_pairs(self, pairs):
+        """
+        Schedules pairs that are new right away and stops polling pairs that are gone.
+        """
+        pairs = set(pairs)
+        now = self.clock()
+        for pair in pairs - self.pairs:
+            heapq.heappush(self.queue, (now, pair))
+        for pair in self.pairs - pairs:
+            self.failures.pop(pair, None)
+            self.last_prices.pop(pair, None)
+        self.pairs = pairs
+
+    def reschedule(self, pair, now, failed=False):
+        if failed:
+            self.failures[pair] = self.failures.get(pair, 0) + 1
+            delay = min(self.interval(pair) * 2 ** self.failures[pair], self.max_backoff)
+        else:
+            self.failures[pair] = 0
+            delay = self.interval(pair)
+        heapq.heappush(self.queue, (now + delay, pair))
+
+    def due(self, now):
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            _, pair = heapq.heappop(self.queue)
+            if pair in self.pairs and pair not in due:
+                due.append(pair)
+        return due
+
+    def run_once(self):
+        """
+        Polls the pairs that are due, or sleeps until the next one is. Returns the pairs that were polled.
+        Errors from the price source are raised after the failing pairs have been rescheduled with backoff.
+        """
+        now = self.clock()
+        due = self.due(now)
+        if not due:
+            if self.queue:
+                self.sleep(max(0, self.queue[0][0] - now))
+            return []
+
+        # The pairs themselves too, for sources that quote them directly
+        coins = {coin for pair in due for coin in pair.split("/")} | set(due)
+        try:
+            quotes = self.price_source.quotes(coins)
+        except Exception:
+            for pair in due:
+                self.reschedule(pair, now, failed=True)
+            raise
+        received_at = self.clock()
+
+        rates = RateMatrix(quotes)
+        for pair in due:
+            unit_price = rates.rate(pair)
+            if unit_price is None:
+                logger.warning("missing price", extra={'pair': pair})
+                self.reschedule(pair, now, failed=True)
+                continue
+            self.reschedule(pair, now)
+            if self.last_prices.get(pair) != unit_price:
+                self.on_update(pair, unit_price, received_at)
+                self.last_prices[pair] = unit_price
+        return due
@@ -0,0 +1,260 @@
+import logging
+import multiprocessing
+import queue
+import time
+import zlib
+from logs import setup_logging
+from metrics import REGISTRY
+from scheduler import PairScheduler
+
+logger = logging.getLogger("sharded_agent")
+# Seconds between a shard's reports of the metrics it recorded
+METRICS_EVERY = 1
+
+shard_batch_seconds = REGISTRY.histogram("shard_batch_seconds", "Time a shard spent on one batch of price updates", ["shard"])
+shard_fills_total = REGISTRY.counter("shard_fills_total", "Fills reported by each shard", ["shard"])
+shard_errors_total = REGISTRY.counter("shard_errors_total", "Errors reported by each shard", ["shard"])
+shard_restarts_total = REGISTRY.counter("shard_restarts_total", "Shard processes restarted after exiting", ["shard"])
+
+def shard_of(pair, shards):
+    # crc32 rather than hash(), which is randomized per process
+    return zlib.crc32(pair.encode()) % shards
+
+class ShardFilter:
+    """
+    WallRegistry include filter that keeps the walls whose pair belongs to one shard.
+    """
+    def __init__(self, shard, shards):
+        self.shard = shard
+        self.shards = shards
+
+    def __call__(self, row):
+        return shard_of(row.pair, self.shards) == self.shard
+
+def run_worker(shard, shards, updates, results, refresh, log_level, log_format, status_every, balances, budget_mode):
+    """
+    Entry point of a shard process. Loads the walls of the shard's pairs into trade_agent's registry and trigger
+    index, steps them for each batch of prices from updates and records their fills, reporting to results. The
+    shard's budget gets an equal share of each balance. What the shard records in its metrics registry, such as
+    step and SQL times, is sent along to be merged into the coordinator's, which serves /metrics; each batch
+    counts as a cycle.
+
+    Messages on updates: ('prices', [(pair, unit_price, received_at), ...]) or ('stop',).
+    Messages on results: ('pairs', shard, pairs, walls), ('done', shard, prices, fills, seconds),
+    ('metrics', shard, taken), ('error', shard, message) and ('stopped', shard).
+    """
+    # Imported here so only the shard processes load the agent's wall state
+    import trade_agent
+    setup_logging(log_level, log_format)
+    trade_agent.status_sampler.interval = status_every
+    trade_agent.wall_registry.include = ShardFilter(shard, shards)
+    trade_agent.budget = trade_agent.BudgetAllocator({coin: balance / shards for coin, balance in balances.items()}, mode=budget_mode)
+
+    refreshed_at = None
+    reported_at = time.monotonic()
+    while True:
+        try:
+            if refreshed_at is None or time.monotonic() - refreshed_at >= refresh:
+                changed = trade_agent.refresh_walls()
+                if changed or refreshed_at is None:
+                    results.put(('pairs', shard, trade_agent.trigger_index.pairs(), len(trade_agent.wall_registry)))
+                refreshed_at = time.monotonic()
+            try:
+                message = updates.get(timeout=max(0, refreshed_at + refresh - time.monotonic()))
+            except queue.Empty:
+                continue
+            if message[0] == 'stop':
+                break
+            started = time.perf_counter()
+            with trade_agent.cycle_seconds.time():
+                fills = trade_agent.process_pairs(message[1])
+            results.put(('done', shard, len(message[1]), fills, time.perf_counter() - started))
+            if time.monotonic() - reported_at >= METRICS_EVERY:
+                results.put(('metrics', shard, REGISTRY.take()))
+                reported_at = time.monotonic()
+        except Exception as e:
+            logger.exception("shard error", extra={'shard': shard})
+            results.put(('error', shard, str(e)))
+            time.sleep(1)
+    results.put(('metrics', shard, REGISTRY.take()))
+    results.put(('stopped', shard))
+
+class ShardedAgent:
+    def __init__(self, shards, price_source, intervals=None, default_interval=60, max_backoff=900, refresh=60,
+                 log_level='INFO', log_format='text', status_every=300, balances=None, budget_mode='scale',
+                 monitoring_client=None, on_fills=None):
+        """
+        Runs the agent's walls in shards processes, partitioned by a hash of their pair.
+
+        This coordinator process polls prices once for every pair with a PairScheduler and sends each shard the
+        updates for its pairs over a local queue, in order. Each shard keeps its own registry and trigger index,
+        steps its walls and records their fills; SQLite's write lock serializes the fills of different shards.
+        Shards report their pairs, batch timings, fills and errors back; errors and shard processes that exit
+        go to monitoring_client, and exited shards are restarted.
+
+        Parameters:
+        - shards (int): Number of worker processes.
+        - price_source (PriceSource): Where quotes come from; only this process calls it.
+        - intervals, default_interval, max_backoff: Poll schedule, as for PairScheduler.
+        - refresh (float): Seconds between each shard's checks of the database for wall changes.
+        - log_level, log_format, status_every: Logging settings of the shard processes.
+        - balances (dict, optional), budget_mode (str): The agent's budget, as for BudgetAllocator. Each shard is
+          given an equal share of every balance, as a shard can't see what the others spend.
+        - monitoring_client (MonitoringClient, optional): Told about successful polls and errors.
+        - on_fills (callable, optional): Called after a shard reports fills, e.g. to wake the outbox worker.
+
+        Example Usage:
+        agent = ShardedAgent(4, CoinGeckoSource(), default_interval=60)
+        agent.run()
+        """
+        self.shards = shards
+        self.price_source = price_source
+        self.refresh = refresh
+        self.worker_settings = (refresh, log_level, log_format, status_every, dict(balances or {}), budget_mode)
+        self.monitoring_client = monitoring_client
+        self.on_fills = on_fills
+        # The scheduler's waits for the next due pair are spent handling shard reports
+        self.scheduler = PairScheduler(price_source, self.on_update, intervals=intervals, default_interval=default_interval, max_backoff=max_backoff, sleep=self.wait)
+        # spawn rather than fork: this process runs logging, metrics and outbox threads
+        self.context = multiprocessing.get_context('spawn')
+        self.results = self.context.Queue()
+        self.updates = [self.context.Queue() for _ in range(shards)]
+        self.processes = [None] * shards
+        self.pending = [[] for _ in range(shards)]
+        self.pairs = [None] * shards
+        self.walls = [0] * shards
+        self.updates_sent = 0
+        self.fills = 0
+        self.reported_at = time.monotonic()
+
+    def start_worker(self, shard):
+        process = self.context.Process(target=run_worker, name="shard-%d" % shard,
+                                       args=(shard, self.shards, self.updates[shard], self.results) + self.worker_settings)
+        process.start()
+        self.processes[shard] = process
+
+    def on_update(self, pair, unit_price, received_at):
+        self.pending[shard_of(pair, self.shards)].append((pair, unit_price, received_at))
+
+    def send_pending(self):
+        for shard, batch in enumerate(self.pending):
+            if batch:
+                self.updates[shard].put(('prices', batch))
+                self.updates_sent += len(batch)
+                self.pending[shard] = []
+
+    def handle(self, message):
+        kind, shard = message[0], message[1]
+        if kind == 'pairs':
+            self.pairs[shard], self.walls[shard] = message[2], message[3]
+            if all(pairs is not None for pairs in self.pairs):
+                self.scheduler.sync_pairs([pair for pairs in self.pairs for pair in pairs])
+                # Re-evaluate every pair at its next poll so new and edited walls see the current price
+                self.scheduler.last_prices.clear()
+        elif kind == 'done':
+            _, _, prices, fills, seconds = message
+            shard_batch_seconds.observe(seconds, shard=shard)
+            if fills:
+                self.fills += fills
+                shard_fills_total.inc(fills, shard=shard)
+                if self.on_fills is not None:
+                    self.on_fills()
+        elif kind == 'metrics':
+            REGISTRY.merge(message[2])
+        elif kind == 'error':
+            shard_errors_total.inc(shard=shard)
+            if self.monitoring_client is not None:
+                self.monitoring_client.record_error("shard %d: %s" % (shard, message[2]))
+
+    def collect(self, timeout=0):
+        """
+        Handles the messages shards have sent, waiting up to timeout seconds for the first one.
+        """
+        try:
+            message = self.results.get(timeout=timeout) if timeout > 0 else self.results.get_nowait()
+            while True:
+                self.handle(message)
+                message = self.results.get_nowait()
+        except queue.Empty:
+            pass
+
+    def wait(self, seconds):
+        deadline = time.monotonic() + seconds
+        while True:
+            self.check_workers()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.collect(timeout=min(remaining, 1))
+
+    def check_workers(self):
+        for shard, process in enumerate(self.processes):
+            if process.exitcode is not None:
+                logger.error("shard exited, restarting", extra={'shard': shard, 'exitcode': process.exitcode})
+                shard_restarts_total.inc(shard=shard)
+                if self.monitoring_client is not None:
+                    self.monitoring_client.record_error("shard %d exited with code %s" % (shard, process.exitcode))
+                # Updates still queued for it are processed by the new process
+                self.start_worker(shard)
+
+    def report(self):
+        if time.monotonic() - self.reported_at < self.refresh:
+            return
+        self.reported_at = time.monotonic()
+        logger.info("shards", extra={'shards': self.shards, 'walls': sum(self.walls), 'pairs': len(self.scheduler.pairs), 'updates': self.updates_sent, 'fills': self.fills})
+
+    def run(self):
+        for shard in range(self.shards):
+            self.start_worker(shard)
+        # Polling starts once every shard has loaded its walls, so none misses the first prices
+        while any(pairs is None for pairs in self.pairs):
+            self.check_workers()
+            self.collect(timeout=1)
+
+        try:
+            while not getattr(self.price_source, 'done', False):
+                try:
+                    self.check_workers()
+                    self.collect()
+                    if self.scheduler.run_once():
+                        self.send_pending()
+                        if self.monitoring_client is not None:
+                            self.monitoring_client.record_success()
+                    elif not self.scheduler.queue:
+                        # No walls yet
+                        self.wait(1)
+                    self.report()
+                except Exception as e:
+                    # Updates of pairs fetched before the error still go out
+                    self.send_pending()
+                    if self.monitoring_client is not None:
+                        self.monitoring_client.record_error(str(e))
+                    logger.exception("coordinator error")
+                    time.sleep(1)
+        finally:
+            self.stop()
+
+    def stop(self, timeout=60):
+        """
+        Lets every shard finish the updates already sent to it, then stops it.
+        """
+        for shard in range(self.shards):
+            self.updates[shard].put(('stop',))
+        stopped = set()
+        deadline = time.monotonic() + timeout
+        while len(stopped) < self.shards and time.monotonic() < deadline:
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                if all(process.exitcode is not None for process in self.processes):
+                    break
+                continue
+            if message[0] == 'stopped':
+                stopped.add(message[1])
+            else:
+                self.handle(message)
+        for process in self.processes:
+            process.join(timeout=max(0, deadline - time.monotonic()))
+            if process.exitcode is None:
+                process.terminate()
+        logger.info("shards stopped", extra={'walls': sum(self.walls), 'updates': self.updates_sent, 'fills': self.fills})
@@ -0,0 +1,143 @@
+import argparse
+import csv
+import itertools
+import os
+import random
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import numpy as np
+from backtest import backtest, load_prices
+from walls import format_number
+
+PARAMETERS = ['bid_price', 'ask_price', 'spread', 'quantities', 'keep']
+
+prices = None
+
+def attach_prices(path):
+    """
+    Worker initializer. Maps the price file read-only so every worker shares the same pages instead of
+    receiving a pickled copy.
+    """
+    global prices
+    prices = np.load(path, mmap_mode='r')
+
+def run_config(config):
+    result = backtest(config, prices)
+    summary = result.summary()
+    return dict(config, **{key: summary[key] for key in ['fills', 'holdings', 'profits', 'cash', 'equity']})
+
+def run_chunk(configs):
+    return [run_config(config) for config in configs]
+
+def grid_configs(grid, pair="TEST/NANO"):
+    """
+    Yields every combination of the values in grid, skipping configs whose ask_price is below bid_price.
+
+    Parameters:
+    - grid (dict): Maps each Walls parameter to a list of values. quantities values are lists of wall sizes.
+    """
+    for values in itertools.product(*[grid[name] for name in PARAMETERS]):
+        config = dict(zip(PARAMETERS, values), pair=pair)
+        if config['ask_price'] >= config['bid_price']:
+            yield config
+
+def sample_configs(grid, samples, pair="TEST/NANO", seed=None):
+    """
+    Yields samples configs with each parameter picked at random from grid.
+    """
+    rng = random.Random(seed)
+    produced = 0
+    while produced < samples:
+        config = {name: rng.choice(grid[name]) for name in PARAMETERS}
+        config['pair'] = pair
+        if config['ask_price'] >= config['bid_price']:
+            produced += 1
+            yield config
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def sweep(configs, price_data, workers=None, chunk_size=64, sort_by='profits'):
+    """
+    Backtests configs across a process pool and returns the results ranked by sort_by, best first.
+
+    Parameters:
+    - configs (iterable of dict): Walls keyword arguments.
+    - price_data (numpy array or str): Prices per tick, or a path to a CSV or .npy file. .npy files are mapped
+      directly; anything else is written to a temporary .npy file first.
+    - workers (int, optional): Number of processes. Defaults to the number of CPU cores.
+    - sort_by (str): Result column to rank by, e.g. 'profits', 'holdings' or 'equity'.
+
+    Returns:
+    - A list of dicts holding the config and its fills, holdings, profits, cash and equity.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if isinstance(price_data, str) and price_data.endswith('.npy'):
+            path = price_data
+        else:
+            data = load_prices(price_data) if isinstance(price_data, str) else price_data
+            path = os.path.join(tmp, 'prices.npy')
+            np.save(path, np.ascontiguousarray(data, dtype=np.float64))
+
+        results = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_prices, initargs=(path,)) as executor:
+            for chunk in executor.map(run_chunk, chunked(configs, chunk_size)):
+                results.extend(chunk)
+
+    results.sort(key=lambda row: row[sort_by], reverse=True)
+    return results
+
+def parse_values(text):
+    return [Decimal(value) for value in text.split(',')]
+
+def parse_ladders(text):
+    return [[Decimal(amount) for amount in ladder.split(':')] for ladder in text.split(',')]
+
+def print_table(results, limit):
+    print("%-4s %-10s %-10s %-6s %-16s %-8s %-6s %-12s %-12s" % ("rank", "bid", "ask", "spread", "quantities", "keep", "fills", "holdings", "profits"))
+    for rank, row in enumerate(results[:limit], 1):
+        quantities = ":".join(str(amount) for amount in row['quantities'])
+        print("%-4d %-10s %-10s %-6s %-16s %-8s %-6d %-12s %-12s" % (rank, row['bid_price'], row['ask_price'], row['spread'], quantities, row['keep'], row['fills'], format_number(row['holdings']), format_number(row['profits'])))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backtest a grid or random sample of wall configs in parallel.")
+    parser.add_argument('prices', help="CSV or .npy file of prices")
+    parser.add_argument('--pair', default="TEST/NANO")
+    parser.add_argument('--bid-price', type=parse_values, required=True, help="comma separated, e.g. 0.3,0.4")
+    parser.add_argument('--ask-price', type=parse_values, required=True, help="comma separated, e.g. 0.6,0.8")
+    parser.add_argument('--spread', type=parse_values, default=[Decimal(2)])
+    parser.add_argument('--quantities', type=parse_ladders, default=[[Decimal(10)]], help="comma separated ladders of colon separated sizes, e.g. 10:20:40,5:10")
+    parser.add_argument('--keep', type=parse_values, default=[Decimal(0)])
+    parser.add_argument('--samples', type=int, help="random sample size instead of the full grid")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--sort', default='profits', choices=['profits', 'holdings', 'equity', 'cash', 'fills'])
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--out', help="write every result to this CSV file")
+    args = parser.parse_args(argv)
+
+    grid = {name: getattr(args, name) for name in PARAMETERS}
+    if args.samples:
+        configs = sample_configs(grid, args.samples, args.pair, args.seed)
+    else:
+        configs = grid_configs(grid, args.pair)
+    results = sweep(configs, args.prices, workers=args.workers, sort_by=args.sort)
+    print_table(results, args.top)
+
+    if args.out:
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['pair'] + PARAMETERS + ['fills', 'holdings', 'profits', 'cash', 'equity'])
+            writer.writeheader()
+            for row in results:
+                writer.writerow(dict(row, quantities=":".join(str(amount) for amount in row['quantities'])))
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,143 +1,329 @@
-import requests
-import urllib
+import argparse
+import logging
 import time
-import datetime
-from decimal import Decimal, getcontext, localcontext
-import os
-import json
-from walls import Walls, format_number
-from notification import notification
-from db import Wall, OrderExecution
+from decimal import Decimal
+from walls import format_number
+from budget import BudgetAllocator, spends
+from outbox import OutboxWorker
+from logs import Sampler, setup_logging
+from db import init_db, record_execution
 from monitoring_client import MonitoringClient
+from metrics import REGISTRY, serve as serve_metrics
+from price_sources import CoinGeckoSource, ReplaySource, RecordingSource, TimedSource
+from rates import RateMatrix
+from scheduler import PairScheduler, LatencyStats
+from trigger_index import TriggerIndex
+from wall_history import load_walls, build_walls, print_potential_spend
+from wall_registry import WallRegistry
 
+logger = logging.getLogger("trade_agent")
 monitoring_client = MonitoringClient()
+coingecko = None
+step_latency = LatencyStats()
+trigger_index = TriggerIndex()
+wall_registry = WallRegistry()
+outbox_worker = OutboxWorker()
+# Without balances every action goes through
+budget = BudgetAllocator()
+# One INFO status line per wall every 5 minutes; the others are logged at DEBUG
+status_sampler = Sampler(300)
+# One budget warning per coin every 5 minutes
+budget_sampler = Sampler(300)
 
-def print_trade_wall_status(wall, unit_price, proposed_action, history):
-    holdings = wall.calculate_holdings(history)
-    potential_cost = wall.potential_spend(history)[1]
-    print(f"=== Wall Status: {wall.pair} ===")
-    print(f"Market Price: {format_number(unit_price)} {wall.pair.split('/')[1]} per {wall.pair.split('/')[0]}")
-    print(f"Holdings: {format_number(holdings)} {wall.pair.split('/')[0]}")
-    print(f"Potential Cost: {format_number(potential_cost)} {wall.pair.split('/')[1]}")
-    
+cycle_seconds = REGISTRY.histogram("trade_agent_cycle_seconds", "Duration of a process_walls() cycle or of a poll of due pairs, including the walls stepped")
+price_fetch_seconds = REGISTRY.histogram("trade_agent_price_fetch_seconds", "Latency of price source quotes() calls")
+step_seconds = REGISTRY.histogram("trade_agent_step_seconds", "Time spent in a wall's step()")
+update_to_step_seconds = REGISTRY.histogram("trade_agent_update_to_step_seconds", "Delay from a price arriving to a wall's step()")
+fills_total = REGISTRY.counter("trade_agent_fills_total", "Fills recorded", ["type"])
+errors_total = REGISTRY.counter("trade_agent_errors_total", "Errors caught by the agent loop")
+budget_actions_total = REGISTRY.counter("trade_agent_budget_actions_total", "Proposed actions cut back by the budget check", ["result"])
+
+def log_wall_status(wall_id, wall, unit_price, proposed_action, history=None, position=None, level=logging.INFO):
+    """
+    Logs one status line for a wall: price, holdings, potential cost, fill count and the proposed action. With a
+    history list, each past trade is also logged at DEBUG. Nothing is computed when level is disabled.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if position is None:
+        position = wall.ledger(history)
+    fields = {
+        'wall': wall_id,
+        'pair': wall.pair,
+        'price': format_number(unit_price),
+        'holdings': format_number(wall.calculate_holdings(position)),
+        'potential_cost': format_number(wall.potential_spend(position)[1]),
+        'fills': position.count,
+        'action': proposed_action[0] if proposed_action else None,
+    }
     if proposed_action:
-        action = 'Buy' if proposed_action[0] == 'buy' else 'Sell'
-        amount = format_number(proposed_action[1][1])
-        price = format_number(proposed_action[1][0])
-        print(f"Action: {action} {amount} at {price}/{wall.pair.split('/')[1]}")
-    else:
-        print("Action: None required")
-    
-    if history:
-        print("Trade History:")
+        fields['amount'] = format_number(proposed_action[1][0])
+    logger.log(level, "wall status", extra=fields)
+
+    if history and logger.isEnabledFor(logging.DEBUG):
         for action, (amount, total_cost) in history:
-            price_per_unit = total_cost / amount
-            verb = 'Bought' if action == 'buy' else 'Sold'
-            print(f" - {verb} {format_number(amount)} {wall.pair.split('/')[0]} at {format_number(price_per_unit)} {wall.pair.split('/')[1]} each for {format_number(total_cost)} {wall.pair.split('/')[1]} total")
-    else:
-        print("Trade History: None")
-    print("===")
+            logger.debug("trade", extra={'wall': wall_id, 'pair': wall.pair, 'type': action, 'amount': format_number(amount), 'price': format_number(total_cost / amount), 'total': format_number(total_cost)})
 
-def urlopen(url, timeout=60, max_retries=3, retry_delay=5):
-    retries = 0
-    while retries < max_retries:
-        try:
-            req = urllib.request.Request(url, headers={'User-Agent': "trade_agent"})
-            return urllib.request.urlopen(req, timeout=timeout)
-        except urllib.error.URLError as e:
-            print(f"Error occurred while making API request: {str(e)}")
-            retries += 1
-            if retries < max_retries:
-                print(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-            else:
-                raise
-
-def coingecko_details(ids):
-    all_coins = []
-    cmc = "https://api.coingecko.com/api/v3/coins/markets?vs_currency=usd&ids=" + ids
-    return json.loads(urlopen(cmc, timeout=5).read().decode('utf-8'))
+def get_coingecko():
+    # Created on first use; its feed loads aiohttp, which replaying a tape never needs
+    global coingecko
+    if coingecko is None:
+        coingecko = CoinGeckoSource()
+    return coingecko
 
 def flatten(xss):
     return [x for xs in xss for x in xs]
 
 def market_sell(db_wall, wall, amount, ask, lhs, rhs):
     # Automation can happen here
-    notification("Trade Walls: sell %s estimated %.2e %s for %.2e %s" % (wall.pair, amount, lhs, ask*amount, rhs))
-    OrderExecution.create(wall=db_wall, amount=amount, total_price=(ask*amount), type='sell')
+    # The fill and its alert are stored in one transaction; outbox_worker sends the alert off the trading loop
+    message = "Trade Walls: sell %s estimated %.2e %s for %.2e %s" % (wall.pair, amount, lhs, ask*amount, rhs)
+    execution = record_execution(db_wall, 'sell', amount, ask*amount, notification=message)
+    fills_total.inc(type='sell')
+    logger.info("fill", extra={'wall': execution.wall_id, 'pair': wall.pair, 'type': 'sell', 'amount': format_number(amount), 'price': format_number(ask)})
+    outbox_worker.wake()
 
 def market_buy(db_wall, wall, amount, bid, lhs, rhs):
     # Automation can happen here
-    notification("Trade Walls: buy %s estimated %.2e %s for %.2e %s" % (wall.pair, amount, lhs, bid*amount, rhs))
-    OrderExecution.create(wall=db_wall, amount=amount, total_price=(bid*amount), type='buy')
-
-def get_market_trade_history(db_wall):
-    return [(order.type, (Decimal(order.amount), Decimal(order.total_price))) for order in db_wall.executions]
-
-def process_walls():
-    # Query all Wall objects
-    db_walls = Wall.select()
-
-    walls = []
-    # Print each Wall object
-    for wall in db_walls:
-        unit = wall.pair.split("/")[1]
-        token = wall.pair.split("/")[0]
-        print(f"{wall.pair} Bid Price: {wall.bid_price} {unit}, Ask price: {wall.ask_price} {unit}, Keep: {wall.keep} {token}, Quantity: {wall.quantity}")
-        walls.append(Walls(pair=wall.pair, bid_price=Decimal(wall.bid_price), ask_price=Decimal(wall.ask_price), keep=Decimal(wall.keep), quantities=[Decimal(wall.quantity)]))
-
-    total_potential = {}
-    for db_wall, wall in zip(db_walls, walls):
-        history = get_market_trade_history(db_wall)
-        base = wall.pair.split("/")[1]
-        if base not in total_potential:
-            total_potential[base] = 0
-        print("Potential spend for", ("%-12s" % wall.pair.split("/")[0]), format_number(wall.potential_spend(history=history)[1]), wall.pair.split("/")[1])
-        total_potential[base] += wall.potential_spend(history=history)[1]
-
-    for coin in total_potential.keys():
-        print("Total potential spend for ", coin, "=", format_number(total_potential[coin]))
-
-    coins = [wall.pair.split("/") for wall in walls]
-    coins = list(set(flatten(coins)))
-    details = coingecko_details(",".join(coins))
-    prices = {}
-    for coin in coins:
-        found = False
-        for d in details:
-            if d['id'] == coin:
-                prices[coin] = d['current_price']
-                found = True
-                break
-        if not found:
-            print("Can't find price for", coin)
-
-    ask_cache = {}
-    bid_cache = {}
-    for db_wall, wall in zip(db_walls, walls):
-        pair = wall.pair
-        lhs = pair.split("/")[0]
-        rhs = pair.split("/")[1]
-        lhs_usd_price, rhs_usd_price = prices[lhs], prices[rhs]
-        unit_price = Decimal(lhs_usd_price) / Decimal(rhs_usd_price)
-        history = get_market_trade_history(db_wall)
-        proposed_action = wall.step(Decimal(unit_price), history)
-        print_trade_wall_status(wall, unit_price, proposed_action, history)
-        if proposed_action is not None and proposed_action[0] == "buy":
-            market_buy(db_wall, wall, proposed_action[1][0], proposed_action[1][1], lhs, rhs)
-        if proposed_action is not None and proposed_action[0] == "sell":
-            market_sell(db_wall, wall, proposed_action[1][0], proposed_action[1][1], lhs, rhs)
-
-def main():
-    while True:
+    message = "Trade Walls: buy %s estimated %.2e %s for %.2e %s" % (wall.pair, amount, lhs, bid*amount, rhs)
+    execution = record_execution(db_wall, 'buy', amount, bid*amount, notification=message)
+    fills_total.inc(type='buy')
+    logger.info("fill", extra={'wall': execution.wall_id, 'pair': wall.pair, 'type': 'buy', 'amount': format_number(amount), 'price': format_number(bid)})
+    outbox_worker.wake()
+
+def propose(wall_id, wall, unit_price):
+    """
+    Steps wall at unit_price and logs its status. Returns the proposed action, not yet checked against the budget.
+    """
+    with step_seconds.time():
+        proposed_action = wall.step(Decimal(unit_price))
+    log_wall_status(wall_id, wall, unit_price, proposed_action, position=wall.position, level=logging.INFO if status_sampler.allow(wall_id) else logging.DEBUG)
+    return proposed_action
+
+def execute(db_wall, wall, action):
+    lhs, rhs = wall.pair.split("/")
+    kind, (amount, price) = action
+    if kind == "buy":
+        market_buy(db_wall, wall, amount, price, lhs, rhs)
+    if kind == "sell":
+        market_sell(db_wall, wall, amount, price, lhs, rhs)
+    # Keep the in-memory ledger and the balances in step with the execution just recorded
+    wall.record((kind, (amount, price * amount)))
+    budget.settle(wall.pair, action)
+
+def allocate(proposals):
+    """
+    Checks the actions proposed on one tick, [(wall_id, wall, action)], against the budget in one pass and returns
+    the actions to execute in the same order, None for those deferred.
+    """
+    actions = budget.allocate([(wall.pair, action) for _, wall, action in proposals])
+    for (wall_id, wall, proposed_action), action in zip(proposals, actions):
+        if action != proposed_action:
+            result = 'deferred' if action is None else 'scaled'
+            budget_actions_total.inc(result=result)
+            coin = spends(wall.pair, proposed_action)[0]
+            if budget_sampler.allow(coin):
+                logger.warning("over budget", extra={'coin': coin, 'balance': format_number(budget.balances[coin]), 'mode': budget.mode, 'wall': wall_id, 'result': result})
+    return actions
+
+def warn_over_committed():
+    for coin, (open_buys, balance) in budget.committed().items():
+        if budget_sampler.allow(("committed", coin)):
+            logger.warning("open buys over balance", extra={'coin': coin, 'open_buys': format_number(open_buys), 'balance': format_number(balance)})
+
+def process_wall(db_wall, wall, unit_price):
+    wall_id = getattr(db_wall, 'id', db_wall)
+    proposed_action = propose(wall_id, wall, unit_price)
+    action = allocate([(wall_id, wall, proposed_action)])[0]
+    if action is not None:
+        execute(db_wall, wall, action)
+    return action
+
+def process_walls(price_source=None):
+    if price_source is None:
+        price_source = get_coingecko()
+    with cycle_seconds.time():
+        # Query all Wall objects along with their summaries
+        db_walls = load_walls()
+        walls = build_walls(db_walls)
+        print_potential_spend(walls)
+
+        coins = [wall.pair.split("/") for wall in walls]
+        coins = list(set(flatten(coins)))
+        with price_fetch_seconds.time():
+            quotes = price_source.quotes(set(coins) | {wall.pair for wall in walls})
+        # Each pair's rate is computed once and shared by all of its walls
+        rates = RateMatrix(quotes)
+        for coin in coins:
+            if coin not in rates.usd:
+                logger.warning("missing price", extra={'coin': coin})
+
+        priced, proposals = [], []
+        for db_wall, wall in zip(db_walls, walls):
+            unit_price = rates.rate(wall.pair)
+            if unit_price is not None:
+                priced.append(db_wall)
+                proposals.append((db_wall.id, wall, propose(db_wall.id, wall, unit_price)))
+        # All walls trade on the same prices, so their actions are checked against the budget together
+        for db_wall, (_, wall, _), action in zip(priced, proposals, allocate(proposals)):
+            if action is not None:
+                execute(db_wall, wall, action)
+
+def ticks(updates):
+    """
+    Splits a batch of price updates into ticks at the first repeated pair, so that a wall sees its pair's prices
+    one at a time and in order.
+    """
+    tick, pairs = [], set()
+    for update in updates:
+        if update[0] in pairs:
+            yield tick
+            tick, pairs = [], set()
+        tick.append(update)
+        pairs.add(update[0])
+    if tick:
+        yield tick
+
+def process_pairs(updates):
+    """
+    Evaluates only the walls whose trigger interval a new price crosses, according to trigger_index, for a batch
+    of (pair, unit_price, received_at) updates such as the pairs of one scheduler poll. The actions the walls of one
+    tick propose are checked against the budget together. received_at is the time.monotonic() at which the price
+    arrived; the delay until each wall's step() is recorded in step_latency. Returns the number of walls that filled.
+
+    A wall whose action was deferred or scaled down still triggers at that price and is evaluated again at its
+    pair's next price.
+    """
+    fills = 0
+    for tick in ticks(updates):
+        proposals = []
+        walls = {}
+        for pair, unit_price, received_at in tick:
+            wall_ids = trigger_index.triggered(pair, unit_price)
+            walls[pair] = len(wall_ids)
+            for wall_id in wall_ids:
+                wall = wall_registry.get(wall_id)
+                latency = time.monotonic() - received_at
+                step_latency.observe(latency)
+                update_to_step_seconds.observe(latency)
+                proposals.append((wall_id, wall, propose(wall_id, wall, unit_price)))
+        if not proposals:
+            continue
+
+        pair_fills = dict.fromkeys(walls, 0)
+        for (wall_id, wall, _), action in zip(proposals, allocate(proposals)):
+            if action is not None:
+                execute(wall_id, wall, action)
+                pair_fills[wall.pair] += 1
+                budget.track(wall_id, wall)
+            trigger_index.update(wall_id, wall.pair, *wall.triggers())
+        for pair, unit_price, _ in tick:
+            if walls[pair]:
+                logger.info("price update", extra={'pair': pair, 'price': format_number(unit_price), 'walls': walls[pair], 'fills': pair_fills[pair], 'step_latency': step_latency.summary()})
+        fills += sum(pair_fills.values())
+    warn_over_committed()
+    return fills
+
+def refresh_walls():
+    """
+    Syncs wall_registry with the database, picking up walls added, edited or deleted through the API, and
+    re-indexes the walls that changed. Returns True if any did.
+    """
+    changed, removed = wall_registry.sync()
+    for wall_id in removed:
+        trigger_index.remove(wall_id)
+        budget.forget(wall_id)
+    for wall_id in changed:
+        wall = wall_registry.get(wall_id)
+        trigger_index.update(wall_id, wall.pair, *wall.triggers())
+        budget.track(wall_id, wall)
+    if changed:
+        warn_over_committed()
+    return bool(changed or removed)
+
+def parse_pair_interval(text):
+    pair, seconds = text.split("=")
+    return pair, float(seconds)
+
+def parse_balance(text):
+    coin, amount = text.split("=")
+    return coin, Decimal(amount)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the trade walls agent.")
+    parser.add_argument('--replay', help="play back a recorded CSV/Parquet price tape instead of fetching CoinGecko prices")
+    parser.add_argument('--speed', type=float, help="tape seconds per second when replaying; by default each poll advances one tape timestamp")
+    parser.add_argument('--record', help="append every quote the agent sees to this CSV tape")
+    parser.add_argument('--interval', type=float, default=60, help="default seconds between price polls per pair")
+    parser.add_argument('--pair-interval', type=parse_pair_interval, action='append', default=[], help="poll interval for one pair, e.g. near/nano=10")
+    parser.add_argument('--max-backoff', type=float, default=900, help="longest delay between polls of a pair whose price source is erroring")
+    parser.add_argument('--refresh', type=float, default=60, help="seconds between checks of the database for added, edited or deleted walls")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="DEBUG adds every wall's status on every step")
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'], help="key=value lines or one JSON object per line")
+    parser.add_argument('--status-every', type=float, default=300, help="seconds between INFO status lines for each wall; 0 logs every step")
+    parser.add_argument('--balance', type=parse_balance, action='append', default=[], help="balance of a coin the walls may trade with, e.g. nano=1000; coins without one are not limited")
+    parser.add_argument('--budget-mode', default='scale', choices=['scale', 'defer'], help="scale down the actions of a tick that together exceed a balance, or execute them in order and defer the rest")
+    parser.add_argument('--shards', type=int, default=1, help="split the walls by pair across this many worker processes")
+    parser.add_argument('--metrics-port', type=int, default=9108, help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics; 0 disables")
+    args = parser.parse_args(argv)
+    setup_logging(args.log_level, args.log_format)
+    status_sampler.interval = args.status_every
+    global budget
+    budget = BudgetAllocator(dict(args.balance), mode=args.budget_mode)
+
+    init_db()
+    if args.replay:
+        price_source = ReplaySource(args.replay, speed=args.speed)
+    else:
+        price_source = get_coingecko()
+    if args.record:
+        price_source = RecordingSource(price_source, args.record)
+    price_source = TimedSource(price_source, price_fetch_seconds)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    # Also delivers alerts left pending by a previous run
+    outbox_worker.start()
+    outbox_worker.wake()
+    if args.shards > 1:
+        # Imported here: the single-process agent never needs multiprocessing
+        from sharded_agent import ShardedAgent
+        ShardedAgent(args.shards, price_source, intervals=dict(args.pair_interval), default_interval=args.interval,
+                     max_backoff=args.max_backoff, refresh=args.refresh, log_level=args.log_level,
+                     log_format=args.log_format, status_every=args.status_every,
+                     balances=dict(args.balance), budget_mode=args.budget_mode,
+                     monitoring_client=monitoring_client, on_fills=outbox_worker.wake).run()
+        outbox_worker.drain()
+        return
+    # The scheduler reports each pair of a poll; they are processed together so the budget sees the whole tick
+    updates = []
+    scheduler = PairScheduler(price_source, lambda *update: updates.append(update), intervals=dict(args.pair_interval), default_interval=args.interval, max_backoff=args.max_backoff)
+    refreshed_at = None
+    while not getattr(price_source, 'done', False):
         try:
-            process_walls()
-            monitoring_client.record_success()
-            time.sleep(60)  # Sleep for 60 seconds before the next iteration
+            if refreshed_at is None or time.monotonic() - refreshed_at >= args.refresh:
+                if refresh_walls():
+                    scheduler.sync_pairs(trigger_index.pairs())
+                    # Re-evaluate every pair at its next poll so new and edited walls see the current price
+                    scheduler.last_prices.clear()
+                refreshed_at = time.monotonic()
+            started = time.perf_counter()
+            if scheduler.run_once():
+                batch = updates[:]
+                del updates[:]
+                process_pairs(batch)
+                cycle_seconds.observe(time.perf_counter() - started)
+                monitoring_client.record_success()
+            elif not scheduler.queue:
+                # No walls, so nothing to poll until the next check of the database
+                time.sleep(max(0, refreshed_at + args.refresh - time.monotonic()))
         except Exception as e:
+            errors_total.inc()
             monitoring_client.record_error(str(e))
-            print("An error occurred:", str(e))
-            time.sleep(60)  # Sleep for 60 seconds before retrying
+            logger.exception("agent loop error")
+            time.sleep(1)  # Failing pairs are already backed off by the scheduler
+    # The price source is exhausted, e.g. the end of a replayed tape; deliver what is still pending
+    outbox_worker.drain()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+import bisect
+import math
+
+class TriggerIndex:
+    """
+    Per-pair sorted index of each wall's buy and sell trigger, as returned by Walls.triggers().
+
+    triggered(pair, price) returns the walls that can act at price with a binary search per side, so a price
+    update costs O(log walls + triggered walls) instead of a step() call for every wall on the pair.
+
+    Example Usage:
+    index = TriggerIndex()
+    index.update(1, "near/nano", *wall.triggers())
+    index.triggered("near/nano", Decimal("0.35"))  # [1] if 0.35 is below the wall's buy trigger
+    """
+    def __init__(self):
+        self.books = {}
+        self.counts = {}
+        self.entries = {}
+
+    def update(self, wall_id, pair, buy_trigger, sell_trigger):
+        self.remove(wall_id)
+        buys, sells = self.books.setdefault(pair, ([], []))
+        if buy_trigger is not None:
+            bisect.insort(buys, (buy_trigger, wall_id))
+        if sell_trigger is not None:
+            bisect.insort(sells, (sell_trigger, wall_id))
+        self.counts[pair] = self.counts.get(pair, 0) + 1
+        self.entries[wall_id] = (pair, buy_trigger, sell_trigger)
+
+    def remove(self, wall_id):
+        entry = self.entries.pop(wall_id, None)
+        if entry is None:
+            return
+        pair, buy_trigger, sell_trigger = entry
+        buys, sells = self.books[pair]
+        for book, trigger in ((buys, buy_trigger), (sells, sell_trigger)):
+            if trigger is not None:
+                del book[bisect.bisect_left(book, (trigger, wall_id))]
+        self.counts[pair] -= 1
+        if self.counts[pair] == 0:
+            del self.counts[pair]
+            del self.books[pair]
+
+    def triggered(self, pair, price):
+        """
+        Returns the ids of walls on pair that can act at price: those whose buy trigger is above it and those
+        whose sell trigger is at or below it.
+        """
+        if pair not in self.books:
+            return []
+        buys, sells = self.books[pair]
+        wall_ids = [wall_id for _, wall_id in buys[bisect.bisect_right(buys, (price, math.inf)):]]
+        wall_ids += [wall_id for _, wall_id in sells[:bisect.bisect_right(sells, (price, math.inf))]]
+        return list(dict.fromkeys(wall_ids))
+
+    def pairs(self):
+        return list(self.books.keys())
+
+    def clear(self):
+        self.books = {}
+        self.counts = {}
+        self.entries = {}
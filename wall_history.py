@@ -0,0 +1,55 @@
+import logging
+from decimal import Decimal
+from peewee import prefetch
+from db import Wall, OrderExecution, WallSummary
+from walls import format_number
+from wall_registry import build_wall, summary_position
+
+logger = logging.getLogger(__name__)
+
+def get_market_trade_history(db_wall):
+    return [(order.type, (Decimal(order.amount), Decimal(order.total_price))) for order in db_wall.executions]
+
+def get_market_position(wall, db_wall):
+    return summary_position(wall, db_wall.summaries)
+
+def load_walls(executions=False, pairs=None, ids=None):
+    """
+    Loads every wall with its WallSummary, and optionally its executions, in a fixed number of queries no matter how
+    many walls there are. get_market_position and get_market_trade_history read the prefetched rows instead of querying.
+
+    Parameters:
+    - executions (bool): Also prefetch each wall's executions.
+    - pairs (list of str, optional): Only load walls trading these pairs.
+    - ids (list of int, optional): Only load walls with these ids.
+    """
+    query = Wall.select().order_by(Wall.id)
+    if pairs is not None:
+        query = query.where(Wall.pair.in_(list(pairs)))
+    if ids is not None:
+        query = query.where(Wall.id.in_(list(ids)))
+    if executions:
+        return prefetch(query, WallSummary.select(), OrderExecution.select().order_by(OrderExecution.id))
+    return prefetch(query, WallSummary.select())
+
+def build_walls(db_walls):
+    walls = []
+    for wall in db_walls:
+        logger.debug("wall", extra={'wall': wall.id, 'pair': wall.pair, 'bid_price': wall.bid_price, 'ask_price': wall.ask_price, 'keep': wall.keep, 'quantities': wall.levels(), 'spread': wall.spread})
+        walls.append(build_wall(wall))
+    for db_wall, wall in zip(db_walls, walls):
+        wall.position = get_market_position(wall, db_wall)
+    return walls
+
+def print_potential_spend(walls):
+    total_potential = {}
+    for wall in walls:
+        base = wall.pair.split("/")[1]
+        if base not in total_potential:
+            total_potential[base] = 0
+        potential_spend = wall.potential_spend()[1]
+        logger.debug("potential spend", extra={'pair': wall.pair, 'spend': format_number(potential_spend), 'coin': base})
+        total_potential[base] += potential_spend
+
+    for coin in total_potential.keys():
+        logger.info("total potential spend", extra={'coin': coin, 'spend': format_number(total_potential[coin])})
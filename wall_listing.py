@@ -0,0 +1,129 @@
+import bisect
+import hashlib
+import json
+import logging
+import threading
+from peewee import fn
+from db import Wall, WallSummary, decimal_str
+
+logger = logging.getLogger(__name__)
+
+class WallListing:
+    def __init__(self, registry, page_cache_size=256):
+        """
+        Server-side cache of the GET /api/walls entries, including each wall's status.
+
+        A fingerprint of the Wall and WallSummary tables (row counts, newest wall version, total fills) is read with
+        two aggregate queries per request. While it is unchanged, pages are served from memory. When a wall is
+        added, edited, deleted or filled, the rows are reloaded once and only the walls whose version or fill count
+        changed get their status recomputed. Flask serves requests on several threads, so reading the fingerprint,
+        reloading, serving a page with its ETag and invalidating all hold one lock, which also covers the registry's
+        cache; a page and its ETag always come from the same fingerprint.
+
+        Parameters:
+        - registry (WallRegistry): Cache of built Walls objects.
+        - page_cache_size (int): Number of serialized pages kept per fingerprint.
+        """
+        self.registry = registry
+        self.page_cache_size = page_cache_size
+        self.fingerprint = None
+        self.entries = []
+        self.ids = []
+        self.computed = {}
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def current_fingerprint(self):
+        walls = Wall.select(fn.COUNT(Wall.id), fn.MAX(Wall.version)).scalar(as_tuple=True)
+        summaries = WallSummary.select(fn.COUNT(WallSummary.id), fn.SUM(WallSummary.fills)).scalar(as_tuple=True)
+        return tuple(walls) + tuple(summaries)
+
+    def refresh(self):
+        """
+        Reloads the entries if the tables changed since the last call. Call with the lock held.
+        """
+        fingerprint = self.current_fingerprint()
+        if fingerprint != self.fingerprint:
+            self.reload(fingerprint)
+
+    def reload(self, fingerprint):
+        rows = list(Wall.select().order_by(Wall.id))
+        self.registry.sync(rows)
+        self.registry.load_positions()
+        computed = {}
+        for db_wall in rows:
+            if db_wall.id in self.registry.failed:
+                # Listed so it can be fixed or deleted through the API
+                wall = None
+                key = (db_wall.version, None)
+            else:
+                wall = self.registry.get(db_wall.id)
+                key = (db_wall.version, wall.position.count)
+            cached = self.computed.get(db_wall.id)
+            if cached is None or cached[0] != key:
+                if wall is not None:
+                    logger.debug("wall status", extra={'wall': db_wall.id, 'pair': db_wall.pair, 'keep': wall.keep, 'potential_spend': wall.potential_spend()[1]})
+                cached = (key, {
+                    'pair': db_wall.pair,
+                    'quantity': decimal_str(db_wall.quantity),
+                    'quantities': [decimal_str(quantity) for quantity in db_wall.levels()],
+                    'spread': decimal_str(db_wall.spread),
+                    'ask_price': decimal_str(db_wall.ask_price),
+                    'bid_price': decimal_str(db_wall.bid_price),
+                    'keep': decimal_str(db_wall.keep),
+                    'id': db_wall.id,
+                    'status': wall.status() if wall is not None else "Not trading: " + self.registry.failed[db_wall.id][1]
+                })
+            computed[db_wall.id] = cached
+
+        self.computed = computed
+        self.entries = [computed[db_wall.id][1] for db_wall in rows]
+        self.ids = [db_wall.id for db_wall in rows]
+        self.pages = {}
+        self.fingerprint = fingerprint
+
+    def etag(self, fingerprint, pair, cursor, limit):
+        key = json.dumps([fingerprint, pair, cursor, limit])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def page(self, pair=None, cursor=None, limit=None):
+        """
+        Reloads the entries if the tables changed, then returns (etag, body, next_cursor) for walls with an id above
+        cursor, optionally only those trading pair. body is the serialized JSON array; next_cursor is None on the last
+        page.
+        """
+        with self.lock:
+            self.refresh()
+            key = (pair, cursor, limit)
+            if key in self.pages:
+                return self.pages[key]
+            result = (self.etag(self.fingerprint, pair, cursor, limit),) + self.select(pair, cursor, limit)
+            if len(self.pages) >= self.page_cache_size:
+                self.pages.pop(next(iter(self.pages)))
+            self.pages[key] = result
+            return result
+
+    def select(self, pair, cursor, limit):
+        assert limit is None or limit > 0, "limit must be at least 1"
+        start = 0 if cursor is None else bisect.bisect_right(self.ids, cursor)
+        selected = []
+        next_cursor = None
+        for entry in self.entries[start:]:
+            if pair is not None and entry['pair'] != pair:
+                continue
+            if limit is not None and len(selected) == limit:
+                next_cursor = selected[-1]['id']
+                break
+            selected.append(entry)
+
+        return json.dumps(selected, sort_keys=True), next_cursor
+
+    def invalidate(self, *wall_ids):
+        """
+        Forces a reload on the next request, e.g. after an edit made by this process, rebuilding the given walls.
+        """
+        with self.lock:
+            self.fingerprint = None
+            for wall_id in wall_ids:
+                self.computed.pop(wall_id, None)
+                self.registry.invalidate(wall_id)
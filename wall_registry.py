@@ -0,0 +1,152 @@
+import logging
+from decimal import Decimal
+from db import Wall, WallSummary
+from walls import FixedWalls, ScaledPosition, to_units
+
+logger = logging.getLogger(__name__)
+
+def build_wall(db_wall):
+    """
+    Builds the strategy object for a Wall row, with one level per entry of its ladder. The columns are fixed-point at
+    the scales FixedWalls runs on.
+    """
+    return FixedWalls(pair=db_wall.pair, bid_price=Decimal(db_wall.bid_price), ask_price=Decimal(db_wall.ask_price), keep=Decimal(db_wall.keep),
+                      quantities=[Decimal(quantity) for quantity in db_wall.levels()], spread=Decimal(db_wall.spread))
+
+def summary_position(wall, summaries):
+    """
+    Builds the wall's Position from its WallSummary rows instead of replaying its executions.
+    The position carries holdings, coins traded, fill count and the type and amount of the latest execution, which
+    is what step, triggers, potential_spend and status read, selloff included. profits is the summary's cash flow,
+    the quote coin received from sells minus that spent on buys.
+    """
+    position = wall.ledger()
+    for summary in summaries:
+        position.holdings += Decimal(summary.holdings)
+        position.traded += Decimal(summary.total_bought) + Decimal(summary.total_sold)
+        position.profits += Decimal(summary.cash_flow())
+        position.count += summary.fills
+        if summary.last_type is not None:
+            position.last = (summary.last_type, (Decimal(summary.last_amount), Decimal(summary.last_total_price)))
+            if isinstance(position, ScaledPosition):
+                position.last_units = to_units(summary.last_amount, position.places)
+    return position
+
+def chunks(ids, size=500):
+    # Stay under SQLite's limit on the number of variables in one IN (...) query
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+class RegistryEntry:
+    __slots__ = ('version', 'wall')
+
+    def __init__(self, version, wall):
+        self.version = version
+        self.wall = wall
+
+class WallRegistry:
+    def __init__(self, build=build_wall, include=None):
+        """
+        Keeps built Walls objects between cycles, keyed by wall id.
+
+        sync() compares each row's version column with the version the cached object was built from, so only walls
+        added or edited since the last sync are parsed and built again, and deleted walls are dropped. A row that fails
+        to build, such as one with its ask below its bid, is logged once per version and left out, rather than
+        stopping every other wall from loading; failed holds the error of each.
+
+        Parameters:
+        - build (callable): Builds the strategy object for a Wall row.
+        - include (callable, optional): Only walls whose row include(row) accepts are kept, e.g. the walls of one
+          shard's pairs. It is called with rows that have at least id, version and pair loaded.
+
+        Example Usage:
+        registry = WallRegistry()
+        changed, removed = registry.sync()
+        wall = registry.get(wall_id)
+        """
+        self.build = build
+        self.include = include
+        self.entries = {}
+        self.failed = {}
+
+    def sync(self, rows=None):
+        """
+        Brings the cache in line with the Wall table.
+
+        Parameters:
+        - rows (list of Wall, optional): Full rows the caller already loaded. Without them only ids and versions are
+          read, and stale rows are loaded with their positions.
+
+        Returns:
+        - A tuple (changed, removed) of lists of wall ids. A cached wall whose edited row fails to build is removed.
+        """
+        loaded = rows is not None
+        if rows is None:
+            rows = Wall.select(Wall.id, Wall.version, Wall.pair).order_by(Wall.id)
+        if self.include is not None:
+            rows = [row for row in rows if self.include(row)]
+        versions = {row.id: row.version for row in rows}
+        removed = [wall_id for wall_id in self.entries if wall_id not in versions]
+        for wall_id in removed:
+            del self.entries[wall_id]
+        for wall_id in [wall_id for wall_id in self.failed if wall_id not in versions]:
+            del self.failed[wall_id]
+        changed = [wall_id for wall_id, version in versions.items()
+                   if (wall_id not in self.entries or self.entries[wall_id].version != version) and self.failed.get(wall_id, (None,))[0] != version]
+        if not changed:
+            return changed, removed
+
+        if loaded:
+            stale = set(changed)
+            stale_rows = [row for row in rows if row.id in stale]
+        else:
+            stale_rows = [row for ids in chunks(changed) for row in Wall.select().where(Wall.id.in_(ids))]
+        built = []
+        for row in stale_rows:
+            if self.add(row):
+                built.append(row.id)
+            elif row.id in self.entries:
+                del self.entries[row.id]
+                removed.append(row.id)
+        if not loaded:
+            self.load_positions(built)
+        return built, removed
+
+    def add(self, row):
+        try:
+            wall = self.build(row)
+        except (AssertionError, ArithmeticError, ValueError) as e:
+            if self.failed.get(row.id, (None,))[0] != row.version:
+                logger.error("wall skipped", extra={'wall': row.id, 'pair': row.pair, 'error': str(e)})
+            self.failed[row.id] = (row.version, str(e))
+            return False
+        self.failed.pop(row.id, None)
+        self.entries[row.id] = RegistryEntry(row.version, wall)
+        return True
+
+    def load_positions(self, ids=None):
+        """
+        Sets each cached wall's position from its WallSummary row, in one query per 500 walls.
+        """
+        if ids is None:
+            summaries = WallSummary.select()
+            ids = list(self.entries.keys())
+        else:
+            summaries = [summary for chunk in chunks(ids) for summary in WallSummary.select().where(WallSummary.wall.in_(chunk))]
+        by_wall = {}
+        for summary in summaries:
+            by_wall.setdefault(summary.wall_id, []).append(summary)
+        for wall_id in ids:
+            if wall_id in self.entries:
+                wall = self.entries[wall_id].wall
+                wall.position = summary_position(wall, by_wall.get(wall_id, []))
+
+    def get(self, wall_id):
+        return self.entries[wall_id].wall
+
+    def invalidate(self, wall_id):
+        self.entries.pop(wall_id, None)
+
+    def __len__(self):
+        return len(self.entries)
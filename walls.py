@@ -1,7 +1,61 @@
+import bisect
+import itertools
+import logging
 import math
-from decimal import Decimal, Context
+import random
+from decimal import Decimal, Context, ROUND_HALF_EVEN
+
+logger = logging.getLogger(__name__)
+
+class Position:
+    """
+    Running ledger of the fills of a single wall.
+
+    Every fill updates the totals in O(1), so reading holdings, coins traded or profits costs the same
+    whether the wall has 10 fills or 100k. Fills use the same tuple format as a history list:
+    ('buy' or 'sell', (amount, price)).
+
+    Example Usage:
+    position = Position()
+    position.record(('buy', (Decimal(10), Decimal("0.4"))))
+    position.holdings  # Decimal('10')
+    """
+    __slots__ = ('holdings', 'traded', 'profits', 'count', 'last')
+
+    def __init__(self, initial_holdings=0, history=None):
+        self.holdings = Decimal(0) + Decimal(initial_holdings)
+        self.traded = Decimal(0) + Decimal(initial_holdings)
+        self.profits = Decimal(0)
+        self.count = 0
+        self.last = None
+        if history is not None:
+            self.extend(history)
+
+    def record(self, action):
+        """Applies a single ('buy' or 'sell', (amount, price)) fill to the running totals."""
+        kind, item = action
+        if kind == 'sell':
+            self.holdings -= item[0]
+        if kind == 'buy':
+            self.holdings += item[0]
+        self.traded += item[0]
+        self.profits += item[0] * item[1]
+        self.count += 1
+        self.last = action
+
+    def extend(self, actions):
+        for action in actions:
+            self.record(action)
+
+    def __len__(self):
+        return self.count
 
 class Walls:
+    __slots__ = ('sell_first', 'pair', 'bid_price', 'ask_price', 'spread', 'keep', 'buy_amounts', 'buy_prices', 'sell_prices',
+                 'selloff', 'buy_quantities', 'sell_quantities', 'sell_amounts', 'position', '_history_cache')
+    # Shared by every wall; a Context per instance costs memory with thousands of walls
+    ctx = Context(prec=8)
+
     def __init__(self, pair=None, bid_price=0, ask_price=None, quantities=[], keep=0, spread=2, selloff=0, sell_first=False):
         """
         Initializes a new instance of the Walls class with specified trading parameters.
@@ -19,13 +73,12 @@ class Walls:
         Example Usage:
         wall = Walls(pair="NEAR/NANO", bid_price=0.4, ask_price=0.6, quantities=[10, 20, 40], keep=10, spread=2)
         """
-        assert(ask_price >= bid_price, "ask_price must be > than bid_price for " + pair)
+        assert ask_price >= bid_price, "ask_price must be >= bid_price for " + str(pair)
         self.sell_first = sell_first
         self.pair = pair
         self.bid_price = bid_price
         self.ask_price = ask_price
         self.spread = spread
-        self.ctx = Context(prec=8)
         self.keep = keep
         self.buy_amounts = []
         self.buy_prices = []
@@ -46,15 +99,48 @@ class Walls:
             level +=1
             self.sell_prices.append(unit_price)
             self.sell_amounts.append(quantity)
-        total_cost = 0.0
-        total_profit = 0.0
+        self.position = self.ledger()
+        self._history_cache = None
+
+    def ledger(self, history=None):
+        """
+        Creates a new Position for this wall, optionally seeded with a history list of past actions.
+        """
+        initial_holdings = self.buy_quantities[0] if self.sell_first else 0
+        return Position(initial_holdings, history)
+
+    def record(self, action):
+        """
+        Records a fill on the wall's own ledger. Methods called without a history use this ledger.
+        """
+        self.position.record(action)
+
+    def _position(self, history):
+        """
+        Returns the Position for a history argument. History lists are treated as append-only: repeated calls
+        with the same list only apply the entries added since the previous call.
+        """
+        if history is None:
+            return self.position
+        if isinstance(history, (Position, ScaledPosition)):
+            return history
+        cache = self._history_cache
+        if cache is not None and cache[0] is history:
+            _, consumed, last, position = cache
+            if len(history) >= consumed and (consumed == 0 or history[consumed - 1] is last):
+                position.extend(history[consumed:])
+                self._history_cache = (history, len(history), history[-1] if history else None, position)
+                return position
+        position = self.ledger(history)
+        self._history_cache = (history, len(history), history[-1] if history else None, position)
+        return position
 
     def potential_spend(self, history=None):
         """
         Calculates the potential spending based on the current trading strategy and optionally, a history of past actions.
 
         Parameters:
-        - history (list of tuples, optional): A history of past trading actions, where each action is represented as a tuple ('buy' or 'sell', (amount, price)).
+        - history (list of tuples or Position, optional): A history of past trading actions, where each action is represented as a tuple ('buy' or 'sell', (amount, price)). Defaults to the wall's own ledger.
 
         Returns:
         - A tuple containing the total number of coins purchased and the total potential spend in decimal format.
@@ -63,12 +149,7 @@ class Walls:
         Assuming no prior history and a strategy with quantities [10, 20, 40], the potential spend to establish the first wall at a price of 0.4 NEAR/NANO would be 4 NANO.
         """
         result = Decimal(0)
-        coins_purchased = Decimal(0)
-        if self.sell_first:
-            coins_purchased = Decimal(self.buy_quantities[0])
-        if history is not None:
-            for h in history:
-                coins_purchased += h[1][0]
+        coins_purchased = self._position(history).traded
 
         for amount, price in zip(self.buy_amounts, self.buy_prices):
             amount = Decimal(amount)
@@ -87,7 +168,7 @@ class Walls:
             result += Decimal(mh) * Decimal(self.buy_prices[0])
         return [coins_purchased, result]
 
-    def calculate_holdings(self, history):
+    def calculate_holdings(self, history=None):
         """
         Calculates the current holdings based on a history of trading actions.
 
@@ -100,22 +181,18 @@ class Walls:
         Example:
         After executing buy actions from the provided example, the holdings might be 70 NEAR if all walls have been bought into.
         """
-        holdings = self.ctx.create_decimal_from_float(0)
-        if self.sell_first:
-            holdings += Decimal(self.buy_quantities[0])
-        for action in history:
-            item = action[1]
-            if action[0] == 'sell':
-                holdings -= item[0]
-            if action[0] == 'buy':
-                holdings += item[0]
-
-        return holdings
-
-    def profits(self, history):
+        return self._position(history).holdings
+
+    def profits(self, history=None):
         """
         Calculates the total profit from trading based on a history of actions.
 
+        What this sums depends on where the position came from. Replaying a history adds amount * item[1] for every
+        fill, buys included, where item[1] is the price for fills from step() and the total price for fills read back
+        from OrderExecution. A position the agent or the API loaded from WallSummary (wall_registry.summary_position)
+        holds the cash flow instead: the quote coin received from sells minus that spent on buys. Compare profits only
+        between positions built the same way.
+
         Parameters:
         - history (list of tuples): A history of past trading actions, similar to potential_spend.
 
@@ -125,17 +202,9 @@ class Walls:
         Example Output:
         If after several sell actions at increasing prices, the total profit might be 120 NANO, indicating a successful series of trades.
         """
-        sold = self.ctx.create_decimal_from_float(0.0)
-        for action in history:
-            item = action[1]
-            if action[0] == 'sell':
-                sold += item[0] * item[1]
-            if action[0] == 'buy':
-                sold += item[0] * item[1]
+        return self._position(history).profits
 
-        return sold
-
-    def step(self, current_price, history):
+    def step(self, current_price, history=None):
         """
         Determines the next trading action based on the current price and a history of past actions.
 
@@ -151,7 +220,8 @@ class Walls:
         """
         current_price = Decimal(current_price)
         proposed_action = None
-        current_holdings = self.calculate_holdings(history)
+        position = self._position(history)
+        current_holdings = position.holdings
         available_coins = current_holdings - self.keep
         buy_amount = 0
         sell_amount = 0
@@ -181,14 +251,56 @@ class Walls:
 
         if active_sell_wall:
 
-            if len(history) > 0 and history[-1][0] == 'buy' and self.selloff > 0:
-                sell_amount = bid_price(history[-1][1][0] * self.selloff, bid_price_triggered_sell_wall[0])
+            if position.last is not None and position.last[0] == 'buy' and self.selloff > 0:
+                sell_amount = min(position.last[1][0] * self.selloff, bid_price_triggered_sell_wall[0])
 
             if sell_amount > 0:
                 return ('sell', (sell_amount, current_price))
 
         return None
 
+    def triggers(self, history=None):
+        """
+        Calculates the price interval in which step() proposes nothing for the current holdings.
+
+        Parameters:
+        - history (list of tuples or Position, optional): A history of past trading actions, similar to potential_spend.
+
+        Returns:
+        - A tuple (buy_trigger, sell_trigger). step() can only propose a buy when the price is below buy_trigger and a sell
+          when it is at or above sell_trigger. None means it never will at these holdings.
+
+        Example:
+        With quantities [10, 20, 40], keep 10, bid_price 0.4, ask_price 0.6 and 10 coins held, the wall buys below 0.4
+        and never sells, so this returns (0.4, None).
+        """
+        position = self._position(history)
+        holdings = position.holdings
+
+        buy_trigger = None
+        target_amount = self.keep
+        for price, amount in sorted(zip(self.buy_prices, self.buy_amounts), key=lambda level: level[0], reverse=True):
+            target_amount += amount
+            if target_amount - holdings > 0:
+                buy_trigger = price
+                break
+
+        sell_trigger = None
+        levels = sorted(zip(self.sell_prices, self.sell_amounts), key=lambda level: level[0])
+        if position.last is not None and position.last[0] == 'buy' and self.selloff > 0:
+            if levels:
+                sell_trigger = levels[0][0]
+        else:
+            amount_needed = sum(self.sell_amounts)
+            for i, (price, amount) in enumerate(levels):
+                amount_needed -= amount
+                if i + 1 < len(levels) and levels[i + 1][0] == price:
+                    continue
+                if holdings - (self.keep + amount_needed) > 0:
+                    sell_trigger = price
+                    break
+        return (buy_trigger, sell_trigger)
+
     def print(self):
         """
         Prints a summary of the current trading strategy, including buy and sell walls, unit prices, and other relevant information.
@@ -207,9 +319,10 @@ class Walls:
         print("Unit price", self.buy_prices, "Sell", self.sell_prices)
         print(" --- ")
 
-    def status(self, history):
-        _, potential_spend = self.potential_spend(history)
-        coins_owned = self.calculate_holdings(history)
+    def status(self, history=None):
+        position = self._position(history)
+        _, potential_spend = self.potential_spend(position)
+        coins_owned = position.holdings
 
         if potential_spend > 0:
             return "Will bid at buy price using " + format_number(potential_spend) + " " + self.pair.split("/")[1]
@@ -218,9 +331,202 @@ class Walls:
             response += " Will keep " + format_number(self.keep) + " " + self.pair.split("/")[0] 
             return response
 
-        print("___", coins_owned, potential_spend, history)
+        logger.debug("at keep amount", extra={'pair': self.pair, 'holdings': coins_owned, 'potential_spend': potential_spend, 'fills': len(position)})
         return "At keep amount"
 
+def to_units(value, places):
+    """
+    Converts a number to an integer count of 10**-places units, rounded half-even. Floats are read through their
+    shortest repr, so 0.4 becomes 40 * 10**-2 and not 0.40000000000000002220...
+    """
+    if isinstance(value, float):
+        value = str(value)
+    return int(Decimal(value).scaleb(places).quantize(1, rounding=ROUND_HALF_EVEN))
+
+class ScaledPosition:
+    """
+    Position whose holdings and coins traded are integers in 10**-places units, as used by FixedWalls.
+
+    holdings and traded read and assign Decimals, so code written for Position keeps working; fills are rounded
+    half-even to places, the way the database stores them.
+    """
+    __slots__ = ('places', 'units', 'traded_units', 'profits', 'count', 'last', 'last_units')
+
+    def __init__(self, places, initial_holdings=0, history=None):
+        self.places = places
+        self.units = to_units(initial_holdings, places)
+        self.traded_units = self.units
+        self.profits = Decimal(0)
+        self.count = 0
+        self.last = None
+        self.last_units = 0
+        if history is not None:
+            self.extend(history)
+
+    @property
+    def holdings(self):
+        return Decimal(self.units).scaleb(-self.places)
+
+    @holdings.setter
+    def holdings(self, value):
+        self.units = to_units(value, self.places)
+
+    @property
+    def traded(self):
+        return Decimal(self.traded_units).scaleb(-self.places)
+
+    @traded.setter
+    def traded(self, value):
+        self.traded_units = to_units(value, self.places)
+
+    def record(self, action):
+        """Applies a single ('buy' or 'sell', (amount, price)) fill to the running totals."""
+        kind, item = action
+        units = to_units(item[0], self.places)
+        if kind == 'sell':
+            self.units -= units
+        if kind == 'buy':
+            self.units += units
+        self.traded_units += units
+        self.profits += item[0] * item[1]
+        self.count += 1
+        self.last = action
+        self.last_units = units
+
+    def extend(self, actions):
+        for action in actions:
+            self.record(action)
+
+    def __len__(self):
+        return self.count
+
+def levels_above(prices, amounts):
+    """
+    Returns the prices sorted ascending and, for each index i, the total amount of the levels from i up.
+    """
+    levels = sorted(zip(prices, amounts), key=lambda level: level[0])
+    above = [0] * (len(levels) + 1)
+    for i in range(len(levels) - 1, -1, -1):
+        above[i] = above[i + 1] + levels[i][1]
+    return [price for price, _ in levels], above
+
+class FixedWalls(Walls):
+    """
+    Walls that runs step, triggers and potential_spend on integers: amounts and holdings in 10**-8 units and prices
+    in 10**-12 units, the scales of the Wall columns in db.py. Decimals only appear at the edges, in the actions
+    returned and the totals reported.
+
+    Levels are sorted once with the amount at or above each, so step() and triggers() are a bisect per side and
+    potential_spend() a bisect over the cumulative buy amounts, however deep the ladder. Decimal prices are
+    bisected against the levels as Decimals, which costs less than converting them; float prices are converted to
+    integer units exactly. For walls whose levels and quantities fit those scales the actions are the same as Walls
+    with Decimal parameters. Fill amounts are rounded to 8 places when recorded, which only matters for selloff
+    fractions that need more.
+
+    Example Usage:
+    wall = FixedWalls(pair="NEAR/NANO", bid_price=Decimal("0.4"), ask_price=Decimal("0.6"), quantities=[Decimal(10)])
+    wall.step(Decimal("0.35"))  # ('buy', (Decimal('10.00000000'), Decimal('0.35')))
+    """
+    __slots__ = ('buy_price_units', 'sell_price_units', 'buy_amount_units', 'sell_amount_units', 'keep_units',
+                 'buy_level_units', 'sell_level_units', 'buy_levels', 'sell_levels', 'buy_above', 'sell_above',
+                 'buy_unfilled', 'sell_unfilled', 'buy_filled', 'buy_cost_from')
+    price_places = 12
+    amount_places = 8
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buy_price_units = [to_units(price, self.price_places) for price in self.buy_prices]
+        self.sell_price_units = [to_units(price, self.price_places) for price in self.sell_prices]
+        self.buy_amount_units = [to_units(amount, self.amount_places) for amount in self.buy_amounts]
+        self.sell_amount_units = [to_units(amount, self.amount_places) for amount in self.sell_amounts]
+        self.keep_units = to_units(self.keep, self.amount_places)
+        self.buy_level_units, self.buy_above = levels_above(self.buy_price_units, self.buy_amount_units)
+        self.sell_level_units, self.sell_above = levels_above(self.sell_price_units, self.sell_amount_units)
+        self.buy_levels = [Decimal(units).scaleb(-self.price_places) for units in self.buy_level_units]
+        self.sell_levels = [Decimal(units).scaleb(-self.price_places) for units in self.sell_level_units]
+        # Negated so they ascend and can be bisected: buy_unfilled[i] is minus the amount at or above buy level i,
+        # sell_unfilled[i] minus the amount above sell level i
+        self.buy_unfilled = [-amount for amount in self.buy_above[:-1]]
+        self.sell_unfilled = [-amount for amount in self.sell_above[1:]]
+        # In ladder order: the amount bought once level i is full, and the cost of filling levels i onwards
+        self.buy_filled = list(itertools.accumulate(self.buy_amount_units))
+        self.buy_cost_from = [0] * (len(self.buy_amount_units) + 1)
+        for i in range(len(self.buy_amount_units) - 1, -1, -1):
+            self.buy_cost_from[i] = self.buy_cost_from[i + 1] + self.buy_amount_units[i] * self.buy_price_units[i]
+
+    def ledger(self, history=None):
+        initial_holdings = self.buy_quantities[0] if self.sell_first else 0
+        return ScaledPosition(self.amount_places, initial_holdings, history)
+
+    def amount(self, units):
+        return Decimal(units).scaleb(-self.amount_places)
+
+    def potential_spend(self, history=None):
+        coins_purchased = self._position(history).traded_units
+
+        # The first level the coins traded don't fill, the rest of it, then every level after it in full
+        level = bisect.bisect_right(self.buy_filled, coins_purchased)
+        result = 0
+        if level < len(self.buy_filled):
+            result = (self.buy_filled[level] - coins_purchased) * self.buy_price_units[level] + self.buy_cost_from[level + 1]
+        if self.buy_filled:
+            coins_purchased = max(0, coins_purchased - self.buy_filled[-1])
+
+        mh = self.keep_units - coins_purchased
+        coins_purchased -= self.keep_units
+        if mh > 0:
+            result += mh * self.buy_price_units[0]
+        return [self.amount(coins_purchased), Decimal(result).scaleb(-self.amount_places - self.price_places)]
+
+    def step(self, current_price, history=None):
+        if isinstance(current_price, float):
+            # Floor of the exact value, so price < level exactly when the floor is below the level's units
+            numerator, denominator = current_price.as_integer_ratio()
+            price = numerator * 10 ** self.price_places // denominator
+            buy_levels, sell_levels = self.buy_level_units, self.sell_level_units
+        else:
+            price = current_price
+            buy_levels, sell_levels = self.buy_levels, self.sell_levels
+        position = self._position(history)
+        holdings = position.units
+
+        above = bisect.bisect_right(buy_levels, price)
+        buy_amount = self.keep_units + self.buy_above[above] - holdings
+        if above < len(buy_levels) and buy_amount > 0:
+            return ('buy', (self.amount(buy_amount), Decimal(current_price)))
+
+        above = bisect.bisect_right(sell_levels, price)
+        if above > 0:
+            sell_amount = holdings - self.keep_units - self.sell_above[above]
+            if position.last is not None and position.last[0] == 'buy' and self.selloff > 0:
+                # The lowest sell level is the one triggered; sorting is stable, so ties keep the first level's amount
+                selloff_amount = (position.last_units * self.selloff).quantize(1, rounding=ROUND_HALF_EVEN)
+                sell_amount = min(int(selloff_amount), self.sell_above[0] - self.sell_above[1])
+
+            if sell_amount > 0:
+                return ('sell', (self.amount(sell_amount), Decimal(current_price)))
+
+        return None
+
+    def triggers(self, history=None):
+        position = self._position(history)
+        holdings = position.units
+
+        # The highest buy level whose amount at or above it, plus keep, exceeds the holdings
+        level = bisect.bisect_left(self.buy_unfilled, self.keep_units - holdings) - 1
+        buy_trigger = self.buy_level_units[level] if level >= 0 else None
+
+        sell_trigger = None
+        if position.last is not None and position.last[0] == 'buy' and self.selloff > 0:
+            if self.sell_level_units:
+                sell_trigger = self.sell_level_units[0]
+        else:
+            # The lowest sell level at which the holdings exceed keep plus the amount above it
+            level = bisect.bisect_right(self.sell_unfilled, self.keep_units - holdings)
+            if level < len(self.sell_level_units):
+                sell_trigger = self.sell_level_units[level]
+        return tuple(None if trigger is None else Decimal(trigger).scaleb(-self.price_places) for trigger in (buy_trigger, sell_trigger))
+
 def format_number(value):
     """Format numbers with precision tailored to their magnitude."""
     if abs(value) >= 1e5:
@@ -282,3 +588,28 @@ if __name__ == '__main__':
 
     print("Total profit TEST", wall.calculate_holdings(actions))
     print("Total profit NANO", wall.profits(actions))
+
+    # FixedWalls reproduces Walls with Decimal parameters on random walls, for float prices, Decimal prices and prices on a level
+    rng = random.Random(15)
+    for _ in range(200):
+        bid_price = Decimal(rng.randint(1, 10**6)).scaleb(-6)
+        ask_price = bid_price + Decimal(rng.randint(0, 10**6)).scaleb(-6)
+        # Spreads of 2 and 10 keep up to 4 and 6 levels at 12 places, so Walls' unrounded levels match FixedWalls'
+        spread = rng.choice([2, 10])
+        config = dict(pair="TEST/NANO", bid_price=bid_price, ask_price=ask_price, keep=Decimal(rng.randint(0, 10**6)).scaleb(-4), spread=spread,
+                      quantities=[Decimal(rng.randint(1, 10**9)).scaleb(-4) for _ in range(rng.randint(1, 4 if spread == 2 else 6))], sell_first=rng.random() < 0.2)
+        reference = Walls(**config)
+        fixed = FixedWalls(**config)
+        levels = reference.buy_prices + reference.sell_prices
+        unit_price = float(bid_price)
+        for i in range(300):
+            unit_price *= math.exp(rng.gauss(0, 0.05))
+            current_price = rng.choice([unit_price, Decimal(repr(unit_price)), rng.choice(levels)])
+            expected = reference.step(current_price)
+            assert fixed.step(current_price) == expected, (config, current_price)
+            if expected is not None:
+                reference.record(expected)
+                fixed.record(expected)
+            assert fixed.triggers() == reference.triggers()
+            assert fixed.potential_spend() == reference.potential_spend()
+            assert fixed.calculate_holdings() == reference.calculate_holdings()